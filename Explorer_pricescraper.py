@@ -7,24 +7,24 @@ This module has been created to get price data from Hurtigrutens Explorer cruise
 If run directly from UNIX: Explorer_pricescraper.py
 If run from Windows: python3 Explorer_pricescraper.py
 
-Todo:
-    * Change write-to-csv to write directly to database
-
 Notes:
-    * If body says sold out it will write the sold out row, but it will also write a row with
-      data if it contains data
+    * If body says sold out, dates without voyages are skipped, but dates that still have
+      prices are stored
     * Seems to work well regarding normal tours, but tours with calendar on web page
       needs more testing
 
 """
 
-import csv
-import requests
-import pytz
-import sqlite3
 import re
 from parsel import Selector
 from datetime import datetime
+from cache import ResponseCache
+from client import TRANSIENT, HttpClient
+from metrics import DISABLED, Metrics
+import parsing
+import sharding
+import sinks
+from storage import Checkpoints, StarSchema, TourPages
 
 class HurtigrutenAPI(object):
     """Hurtigruten API scraper.
@@ -33,15 +33,104 @@ class HurtigrutenAPI(object):
     No parameters.
 
     """
+    #Dimension tables of the star schema and their value column
+    DIMENSIONS = {'dimReportDate': 'ReportDate', 'dimShips': 'ShipCode', 'dimCabinCategory': 'Category',
+                  'dimVoyage': 'VoyageType', 'dimDepartureDate': 'DepartureDate', 'dimTour': 'TourName',
+                  'dimDestination': 'Destination', 'dimSourceMarket': 'SourceMarket'}
+    FACT_COLUMNS = ['rDate_id', 'ship_id', 'cat_id', 'type_id', 'dep_id', 'tour_id', 'dest_id', 'source_id', 'price']
+    # Record fields written to dimTour with a new tour
+    EXTRAS = {'dimTour': ('TourImg', 'TourMap')}
+    # Tables of the scraper, formatted with storage.schema()
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS dimReportDate (id {day_id}, ReportDate TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimShips (id integer PRIMARY KEY AUTOINCREMENT, ShipCode TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimCabinCategory (id integer PRIMARY KEY AUTOINCREMENT, Category TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimVoyage (id integer PRIMARY KEY AUTOINCREMENT, VoyageType TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimDepartureDate (id {day_id}, DepartureDate TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimTour (id integer PRIMARY KEY AUTOINCREMENT, TourName TEXT NOT NULL UNIQUE, TourImg TEXT, TourMap TEXT);
+    CREATE TABLE IF NOT EXISTS dimDestination (id integer PRIMARY KEY AUTOINCREMENT, Destination TEXT NOT NULL UNIQUE);    
+    CREATE TABLE IF NOT EXISTS dimSourceMarket (id integer PRIMARY KEY AUTOINCREMENT, SourceMarket TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS Data_Explorer (
+                                    rDate_id integer NOT NULL,
+                                    ship_id integer NOT NULL,
+                                    cat_id integer NOT NULL,
+                                    type_id integer NOT NULL,
+                                    dep_id integer NOT NULL,
+                                    tour_id integer NO NULL,
+                                    dest_id integer NOT NULL,
+                                    source_id integer NOT NULL,
+                                    price {value},
+                                    FOREIGN KEY (rDate_id) references dimReportDate(id),
+                                    FOREIGN KEY (ship_id) references dimShips(id),
+                                    FOREIGN KEY (cat_id) references dimCabinCategory(id),
+                                    FOREIGN KEY (type_id) references dimVoyage(id),
+                                    FOREIGN KEY (dep_id) references dimDepartureDate(id),
+                                    FOREIGN KEY (tour_id) references dimTour(id),
+                                    FOREIGN KEY (dest_id) references dimDestination(id),
+                                    FOREIGN KEY (source_id) references dimSourceMarket(id),
+                                    PRIMARY KEY ({key})){rowid};
+    CREATE TABLE IF NOT EXISTS Data_Explorer_Latest (
+                                    rDate_id integer NOT NULL,
+                                    ship_id integer NOT NULL,
+                                    cat_id integer NOT NULL,
+                                    type_id integer NOT NULL,
+                                    dep_id integer NOT NULL,
+                                    tour_id integer NOT NULL,
+                                    dest_id integer NOT NULL,
+                                    source_id integer NOT NULL,
+                                    price {value},
+                                    PRIMARY KEY (dep_id, ship_id, cat_id, type_id, tour_id, dest_id, source_id)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS Data_Explorer_departure ON Data_Explorer (dep_id, ship_id, rDate_id);
+    {market_index}
+    CREATE INDEX IF NOT EXISTS Data_Explorer_tour ON Data_Explorer (tour_id, rDate_id);
+    CREATE INDEX IF NOT EXISTS Data_Explorer_Latest_tour ON Data_Explorer_Latest (tour_id);
+    CREATE INDEX IF NOT EXISTS Data_Explorer_Latest_market ON Data_Explorer_Latest (source_id, cat_id);
+    PRAGMA user_version = {version};
+                                    '''
+
     def __init__(self):
         self.main = 'https://www.hurtigruten.no'
         self.markets = ['NO', 'FR', 'DE', 'UK', 'US']
         self.voyagetype = 'EXPLORER'
+        # Endpoints, tour pages are fetched from self.main
+        self.travelfilter_url = 'https://www.hurtigruten.com/api/travelfilter?destinationId=&departureMonthYear=&shipId=&marketCode=NO&languageCode=no'
+        self.gateways_url = "https://shadowprodapi.hurtigruten.com/api//travelsuggestions/gateways"
+        self.grouped_url = 'https://shadowprodapi.hurtigruten.com/api/availability/travelsuggestions/grouped'
+        self.quote_url = 'https://shadowprodapi.hurtigruten.com/api/quotes/{}/packagePrices?date={}&voyageId={}'
+        # Prices are written once per quote response, or every batch_size rows if set
+        self.batch_size = None
+        self.wal = False
+        # 'snapshot' writes the full price grid to Data_Explorer every run, 'delta' only writes changes to Data_Explorer_Delta
+        self.storage_mode = 'snapshot'
+        # Create a new database in the compact format (see storage.py), an existing one keeps its format
+        self.compact = False
+        # Export sinks (see sinks.py) every stored row is also written to, on threads of their own
+        self.exports = []
+        # Pooled connections, at most 10 requests/s per host, backoff retries on 429/5xx.
+        # Every response, tour pages included, is also kept in the raw-response cache for 30 days
+        self.client = HttpClient(rate=10, cache=ResponseCache('C:\\Users\\H520139\\.spyder-py3\\HRG\\DBs\\cache'))
+        # Where sql3_storage() opens the database
+        self.location = 'C:\\Users\\H520139\\.spyder-py3\\HRG\\DBs\\'
+        self.dbname = 'Pricing.db'
+        # Failed (tour index, code, market) work, retried at the end of the run
+        self.fails = []
+        self.retry_rounds = 2
+        # Failed work that is not retried, the run is incomplete if there is any
+        self.incomplete = []
+        # Skip work already completed by an earlier run for the same report date
+        self.resume = True
+        # Set in worker processes of scrape_sharded(), rows are sent to the writer over it
+        self.queue = None
+        # Stage timings and counters of a run, set to a metrics.Metrics to record them
+        self.metrics = DISABLED
+        # Gateways response and first date per tour code, its payload doesn't depend on the market
+        self.gateways = {}
 
     def travelfilter_response(self):
         """Get response from main filter page such that we can loop through all tours"""
-        self.travelfilter_url = 'https://www.hurtigruten.com/api/travelfilter?destinationId=&departureMonthYear=&shipId=&marketCode=NO&languageCode=no'
-        self.travel_response = requests.get(self.travelfilter_url).json()
+        response = self.client.get(self.travelfilter_url, 'travelfilter')
+        with self.metrics.time('stage_seconds', stage='decode'):
+            self.travel_response = response.json()
         return self.travel_response
 
     def initial_response(self, i):
@@ -51,6 +140,11 @@ class HurtigrutenAPI(object):
         which is concatenated with the main url link in the __init__,
         then gets the html response from that link from which we can extract tour code(s).
 
+        The page is only downloaded if it changed since it was stored in
+        self.tour_pages (conditional GET), and not requested at all if it was
+        already validated in this run. self.page is None when the stored
+        codes apply.
+
         """
         self.i = i
         self.intermediate_url = self.travel_response['voyages'][self.i]['voyageUrl']
@@ -67,10 +161,20 @@ class HurtigrutenAPI(object):
         except:
             self.map_url = ""
         self.initial_url = self.main + self.intermediate_url
-        self.init_response = requests.get(self.initial_url)
-        self.sel = Selector(self.init_response.text)
+        self.page = None
+        self.sel = None
+        if self.initial_url in self.tour_pages.validated:
+            self.metrics.inc('tour_pages_total', result='reused')
+            return self.page
+        self.init_response = self.client.get(self.initial_url, 'tour_page', headers=self.tour_pages.headers(self.initial_url))
+        if self.init_response.status_code == 304:
+            self.tour_pages.validated.add(self.initial_url)
+            self.metrics.inc('tour_pages_total', result='not_modified')
+        else:
+            self.page = self.init_response.text
+            self.metrics.inc('tour_pages_total', result='fetched')
         """print(self.init_response)"""
-        return self.sel
+        return self.page
 
     def travel_codes(self):
         """Extracts travel codes from the body in the initial response.
@@ -78,8 +182,16 @@ class HurtigrutenAPI(object):
         Returns: list
 
         """
-        self.codes = self.sel.xpath('//script[contains(.,"products")]').extract_first()
-        self.codes = re.findall(r'id: \"([^\"]+)\"',self.codes,flags=0)
+        if self.page is None:
+            self.codes = list(self.tour_pages.get(self.initial_url)[0])
+            return self.codes
+        with self.metrics.time('stage_seconds', stage='html_parse'):
+            self.codes = parsing.tour_codes(self.page)
+            if self.codes is None:
+                # Not the layout the regular expressions expect, parse the DOM
+                self.sel = Selector(self.page)
+                self.codes = self.sel.xpath('//script[contains(.,"products")]').extract_first()
+                self.codes = re.findall(r'id: \"([^\"]+)\"',self.codes,flags=0)
         """self.codes = self.codes.split(',')"""
         """print(self.codes)"""
         return self.codes
@@ -91,11 +203,16 @@ class HurtigrutenAPI(object):
 
         """
         self.code = code
-        self.gateways_url = "https://shadowprodapi.hurtigruten.com/api//travelsuggestions/gateways"
         self.gateways_payload = '{{"travelSuggestionCodes":["{}"],"marketCode":"NO","languageCode":"no"}}'
         self.headers = {'content-type': "application/json"}
-        self.gate_response = requests.post(self.gateways_url, data=self.gateways_payload.format(self.code), headers=self.headers).json()
+        if code in self.gateways:
+            self.gate_response, self.date = self.gateways[code]
+            return self.gate_response, self.date
+        response = self.client.post(self.gateways_url, 'gateways', data=self.gateways_payload.format(self.code), headers=self.headers)
+        with self.metrics.time('stage_seconds', stage='decode'):
+            self.gate_response = response.json()
         self.date = self.gate_response["gateways"][0]["firstAvailableDate"].split('T')[0]
+        self.gateways[code] = (self.gate_response, self.date)
         return self.gate_response, self.date
 
     def grouped_response(self, code, m):
@@ -110,8 +227,9 @@ class HurtigrutenAPI(object):
         self.marketcode = m
         #self.grouped_payload = '{{"packageCode":{},"searchFromDateTime":"{}","cabins":[{{"passengers":[{{"ageCategory":"ADULT","guestType":"REGULAR"}},{{"ageCategory":"ADULT","guestType":"REGULAR"}}]}}],"currencyCode":"NOK","marketCode":"'self.marketcode'","languageCode":"en","quoteId":null,"bookingSourceCode":"TDL_B2C_NO"}}'
         self.grouped_payload = '{{"packageCode":"{}","searchFromDateTime":"{}","cabins":[{{"passengers":[{{"ageCategory":"ADULT","guestType":"REGULAR"}},{{"ageCategory":"ADULT","guestType":"REGULAR"}}]}}],"currencyCode":"NOK","marketCode":"' + str(self.marketcode) +'","languageCode":"no","quoteId":null,"bookingSourceCode":"TDL_B2C_NO"}}'
-        self.grouped_url = 'https://shadowprodapi.hurtigruten.com/api/availability/travelsuggestions/grouped'
-        self.group_response = requests.post(self.grouped_url, data=self.grouped_payload.format(self.code, self.date), headers=self.headers).json()
+        response = self.client.post(self.grouped_url, 'grouped', data=self.grouped_payload.format(self.code, self.date), headers=self.headers)
+        with self.metrics.time('stage_seconds', stage='decode'):
+            self.group_response = response.json()
         self.quote_id = self.group_response["quoteId"]
         """print(self.quote_id)"""
         return self.group_response, self.quote_id
@@ -123,69 +241,44 @@ class HurtigrutenAPI(object):
         self.item = item
         self.voyage_date = self.item["date"].split('T')[0]
         self.voyage_id = self.item["voyages"][0]["voyageId"]
-        self.url = 'https://shadowprodapi.hurtigruten.com/api/quotes/{}/packagePrices?date={}&voyageId={}'
-        self.quote = requests.get(self.url.format(self.quote_id, self.voyage_date, self.voyage_id)).json()
+        response = self.client.get(self.quote_url.format(self.quote_id, self.voyage_date, self.voyage_id), 'package_prices')
+        with self.metrics.time('stage_seconds', stage='decode'):
+            self.quote = response.json()
 
     def sold_out_check(self, i):
         """Checks if text contains sold out.
 
-        If text box in site body contains "sold out", it invokes
-        sold_out_writer() and writes info to csv
+        If text box in site body contains "sold out", self.sold_out is set and
+        dates without voyages are skipped
 
         """
         self.i = i
-        self.sold_out_in_body = self.sel.xpath("//div[@class='top-image-promotion']/text()").extract()
+        if self.page is None:
+            self.sold_out = self.tour_pages.get(self.initial_url)[1]
+            return
+        if self.sel is None:
+            with self.metrics.time('stage_seconds', stage='html_parse'):
+                self.sold_out = parsing.sold_out(self.page)
+            return
+        with self.metrics.time('stage_seconds', stage='html_parse'):
+            self.sold_out_in_body = self.sel.xpath("//div[@class='top-image-promotion']/text()").extract()
         self.sold_out_in_body = [x.lower() for x in self.sold_out_in_body]
         self.sold_out = False
         if any("sold out" in s for s in self.sold_out_in_body):
             self.sold_out = True
-            #self.sold_out_writer(i)
-
-    def initiate_writer(self, name):
-        """Initialize csv writer with header"""
-        self.name = name
-        self.writer = csv.writer(self.name, delimiter=',', lineterminator='\n')
-        self.writer.writerow(('Iteration', 'Timestamp', 'Ship', 'Tourcode',
-                              'Tourname', 'Destination', 'Tourstart', 'PolarInside',
-                              'PolarOutside', 'ArcticSuperior', 'ExpeditionSuite'))
-
-    def sold_out_writer(self, i, item=None):
-        """Writes sold out data"""
-        self.i = i
-        self.item = item
-        if item:
-            self.sold_out_date = self.item["date"].split('T')[0] # Can get date of tour which is sold out using voyage_date
-        else:
-            self.sold_out_date = 0 # If we can't use voyage_date, put 0 instead, because firstAvailableDate (self.date) is not necessarily the one sold out.
 
-        self.row_soldout = (self.i,
-                            datetime.datetime.now(pytz.timezone("Europe/Tallinn")).strftime("%Y-%m-%d"),
-                            self.travel_response["voyages"][self.i]["ships"][0]["id"],
-                            #self.codes, 
-                            self.travel_response["voyages"][self.i]["name"],
-                            self.travel_response["voyages"][self.i]["destination"]["name"],
-                            self.sold_out_date, 0, 0, 0, 0)
-
-        self.writer.writerow(self.row_soldout)
-
-    def quote_writer(self, i, code, item):
-        """Extracts price information from quote and writes it to csv"""
-        self.i = i
-        self.code = code
-        self.item = item
-        self.row = (self.i,
-                    datetime.datetime.now(pytz.timezone("Europe/Tallinn")).strftime("%Y-%m-%d"),
-                    self.item["voyages"][0]["ship"]["shipCode"],
-                    #self.code,
-                    self.travel_response["voyages"][self.i]["name"],
-                    self.travel_response["voyages"][self.i]["destination"]["name"],
-                    self.voyage_date,
-                    self.quote["categoryPrices"][0]['price']['amount'],
-                    self.quote["categoryPrices"][1]['price']['amount'],
-                    self.quote["categoryPrices"][2]['price']['amount'],
-                    self.quote["categoryPrices"][3]['price']['amount'])
-        self.writer.writerow(self.row)
-        """print(self.row)"""
+    def tour_page(self, i):
+        """Codes and sold-out flag of tour i, from its page or from self.tour_pages if the page is unchanged"""
+        self.initial_response(i)
+        self.travel_codes()
+        self.sold_out_check(i)
+        if self.page is not None:
+            headers = self.init_response.headers
+            page = (self.initial_url, self.codes, self.sold_out, headers.get('ETag'), headers.get('Last-Modified'))
+            self.tour_pages.put(*page)
+            if self.queue is not None:
+                # Stored by the writer process, see emit()
+                self.queue.put((self.task, 'tour_page', page))
 
     def startdate(self, start=None):
         if start is None:
@@ -200,117 +293,314 @@ class HurtigrutenAPI(object):
 
     def parse_and_store(self, price):
         self.price = price
+        self.store_rows(self.quote_rows({'categoryPrices': [price]}))
+        if not self.batch_size:
+            self.sink.flush()
+
+    def quote_rows(self, quote=None):
+        """Yields the category prices of a quote (default: the current one) as parsing.ExplorerPrice rows"""
+        voyage = self.travel_response["voyages"][self.i]
+        return parsing.explorer_rows(quote or self.quote, self.curDate, self.item["voyages"][0]["ship"]["shipCode"], self.voyagetype,
+                                     self.voyage_date, voyage["name"], voyage["destination"]["name"], self.marketcode, self.img_url, self.map_url)
+
+    def store_rows(self, rows):
+        """Writes the rows to the star schema and the export sinks"""
+        rows = list(rows)
+        self.sink.write(rows)
+        for row in rows:
+            print(*row[:9])
+
+    def sql3_storage(self, location=None, dbname=None):
+        """Opens and initializes the database, by default at the location and dbname set in __init__"""
+        self.location = location or self.location
+        self.dbname = dbname or self.dbname
+        self.star = StarSchema(self.location+self.dbname, self.SCHEMA, 'Data_Explorer', self.DIMENSIONS, self.FACT_COLUMNS, self.EXTRAS,
+                               mode=self.storage_mode, compact=self.compact, wal=self.wal, batch_size=self.batch_size, metrics=self.metrics)
+        self.connection, self.cr, self.compact = self.star.connection, self.star.cr, self.star.compact
+        self.dims, self.facts = self.star.dims, self.star.facts
+        # Rows are stored in the star schema on this thread and handed to the export sinks, see sinks.py
+        self.sink = sinks.FanOut([self.star] + self.exports)
+        return self.connection, self.cr
+
+    def open_storage(self):
+        self.sql3_storage()
+        self.checkpoints = Checkpoints(self.connection, 'explorer', self.curDate)
+        self.tour_pages = TourPages(self.connection)
+
+    def scraper(self, start=None, replay=False, processes=None):
+        """Scrapes the data from the API
+
+        start: report date ('%Y-%m-%d'), defaults to today.
+        replay: rebuild the database from the response cache without any network
+            calls, start should then be the report date of the run being replayed.
+        processes: shard the tours over this many worker processes, see scrape_sharded().
+
+        """
+        self.startdate(start)
+        self.client.metrics = self.metrics
+        self.gateways = {}
+        self.open_storage()
+        self.client.offline = replay
+        if not replay and self.client.cache is not None:
+            self.client.cache.evict()
+        self.travelfilter_response()
+        if processes:
+            self.scrape_sharded(processes)
+        else:
+            for i in range(len(self.travel_response['voyages'])): # number of tours from travelfilter_response()
+                self.scrape_tour(i)
+        self.retry_fails()
+        self.sink.flush()
+        if self.storage_mode == 'delta' and not self.fails and not self.incomplete:
+            self.facts.close_unseen()
+        self.sink.close()
 
-        self.cr.execute('INSERT OR IGNORE INTO dimReportDate(ReportDate) VALUES (?);', (self.curDate,))
-        self.cr.execute('SELECT id FROM dimReportDate WHERE ReportDate = ?;', (self.curDate, ))
-        self.rDate_id = self.cr.fetchone()[0]
+    def scrape_tour(self, i, only=None):
+        """Scrapes every code and market of tour i.
 
-        self.cr.execute('INSERT OR IGNORE INTO dimShips(ShipCode) VALUES (?);', (self.item["voyages"][0]["ship"]["shipCode"], ))
-        self.cr.execute('SELECT id FROM dimShips WHERE shipCode = ?;', (self.item["voyages"][0]["ship"]["shipCode"], ))
-        self.ship_id = self.cr.fetchone()[0]
+        only: optional list of (code, market) pairs to restrict the scrape to,
+        used when retrying failures.
 
-        self.cr.execute('INSERT OR IGNORE INTO dimCabinCategory(Category) VALUES (?);', (self.price['code'], ))
-        self.cr.execute('SELECT id FROM dimCabinCategory WHERE Category = ?;', (self.price['code'], ))
-        self.cat_id = self.cr.fetchone()[0]
+        Failed work is recorded with fail(), which queues it in self.fails as
+        (i, code, market), or (i, None, None) when the tour page itself could
+        not be fetched.
 
-        self.cr.execute('INSERT OR IGNORE INTO dimVoyage(VoyageType) VALUES (?);', (self.voyagetype, ))
-        self.cr.execute('SELECT id FROM dimVoyage WHERE VoyageType = ?;', (self.voyagetype, ))
-        self.type_id = self.cr.fetchone()[0]
+        Completed work is checkpointed as (i, code, market, date) per quote,
+        (i, code, market, '') per code and market and (i, '', '', '') per tour.
 
-        self.cr.execute('INSERT OR IGNORE INTO dimDepartureDate(DepartureDate) VALUES (?);', (self.voyage_date, ))
-        self.cr.execute('SELECT id FROM dimDepartureDate WHERE DepartureDate = ?;', (self.voyage_date, ))
-        self.dep_id = self.cr.fetchone()[0]
+        """
+        if self.resume and self.checkpoints.done(i, '', '', ''):
+            return
+        try:
+            self.tour_page(i)
+        except Exception as error:
+            self.fail('tour_page', error, (i, None, None))
+            return
+        for code in self.codes:  # from travel_codes()
+            for m in self.markets:
+                if only is not None and (code, m) not in only:
+                    continue
+                if self.resume and self.checkpoints.done(i, code, m, ''):
+                    continue
+                try:
+                    self.scrape_code(code, m)
+                except Exception as error:
+                    self.fail('tour_code', error, (i, code, m))
+        if all(self.checkpoints.done(i, code, m, '') for code in self.codes for m in self.markets):
+            self.emit((i, '', '', ''), [])
 
-        self.cr.execute('INSERT OR IGNORE INTO dimTour(TourName, TourImg, TourMap) VALUES (?, ?, ?);', (self.travel_response["voyages"][self.i]["name"], self.img_url, self.map_url, ))
-        self.cr.execute('SELECT id FROM dimTour WHERE TourName = ?;', (self.travel_response["voyages"][self.i]["name"], ))
-        self.tour_id = self.cr.fetchone()[0]
+    def scrape_code(self, code, m, month=None):
+        """Gets and stores the prices of all dates of one tour code in market m.
 
-        self.cr.execute('INSERT OR IGNORE INTO dimDestination(Destination) VALUES (?);', (self.travel_response["voyages"][self.i]["destination"]["name"], ))
-        self.cr.execute('SELECT id FROM dimDestination WHERE Destination = ?;', (self.travel_response["voyages"][self.i]["destination"]["name"], ))
-        self.dest_id = self.cr.fetchone()[0]
+        month: optional 'YYYY-MM', only the dates in that month are scraped and
+        the code is not checkpointed as complete.
 
-        self.cr.execute('INSERT OR IGNORE INTO dimSourceMarket(SourceMarket) VALUES (?);', (self.marketcode, ))
-        self.cr.execute('SELECT id FROM dimSourceMarket WHERE SourceMarket = ?;', (self.marketcode, ))
-        self.source_id = self.cr.fetchone()[0]
+        """
+        self.gateways_response(code)
+        self.grouped_response(code,m)
+        for item in self.group_response["calendar"]: # loops through all dates from grouped_response() on each code
+            if item["voyages"] is None:
+                if self.sold_out:
+                    continue
+            if month is not None and not item["date"].startswith(month):
+                continue
+            if self.resume and self.checkpoints.done(self.i, code, m, item["date"].split('T')[0]):
+                continue
+            self.get_quote(item)
+            self.emit((self.i, code, m, self.voyage_date), self.quote_rows())
+        if month is None:
+            self.emit((self.i, code, m, ''), [])
+
+    def emit(self, unit, rows):
+        """Stores the rows of a completed unit of work and checkpoints it.
+
+        In a worker process of scrape_sharded() they are queued for the writer
+        process instead, which calls emit() again to store them. The writer
+        also gets the tour pages a worker fetched as unit 'tour_page'.
 
-        self.cr.execute('INSERT OR IGNORE INTO Data_Explorer(rDate_id, ship_id, cat_id, type_id, dep_id, tour_id, dest_id, source_id, price) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);', (self.rDate_id, self.ship_id, self.cat_id, self.type_id, self.dep_id, self.tour_id, self.dest_id, self.source_id, self.price['price']['amount']))
-        print(self.rDate_id, self.ship_id, self.cat_id, self.type_id, self.dep_id, self.tour_id, self.dest_id, self.source_id, self.price['price']['amount'])
-        self.connection.commit()
+        """
+        if unit == 'tour_page':
+            self.tour_pages.put(*rows)
+            return
+        if self.queue is not None or self.metrics.enabled:
+            # quote_rows() is lazy, the quote is walked first so parsing isn't timed as storing (and queued as a list)
+            with self.metrics.time('stage_seconds', stage='parse'):
+                rows = list(rows)
+        if self.queue is not None:
+            self.checkpoints.completed.add(self.checkpoints.cell(unit))
+            self.queue.put((self.task, unit, rows))
+            return
+        with self.metrics.time('stage_seconds', stage='store'):
+            self.store_rows(rows)
+        self.checkpoints.mark(*unit)
+        if not self.batch_size:
+            self.sink.flush()
+
+    def scrape_sharded(self, processes):
+        """Shards the tours over a pool of worker processes.
+
+        Workers fetch and parse one tour at a time, a single writer process owns
+        the sqlite connection and stores the rows in tour order, so the database
+        ends up the same as after a sequential run.
+
+        The tour pages are validated here first, so the TourPage table is
+        updated on this connection and the workers reuse the codes.
 
-    def sql3_storage(self, location='C:\\Users\\H520139\\.spyder-py3\\HRG\\DBs\\', dbname='Pricing.db'):
-        self.location = location
-        self.dbname = dbname
-        self.connection = sqlite3.connect(location+dbname)
-        self.cr = self.connection.cursor()
-        try:
-            self.cr.executescript('''
-    CREATE TABLE IF NOT EXISTS dimReportDate (id integer PRIMARY KEY AUTOINCREMENT, ReportDate TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimShips (id integer PRIMARY KEY AUTOINCREMENT, ShipCode TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimCabinCategory (id integer PRIMARY KEY AUTOINCREMENT, Category TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimVoyage (id integer PRIMARY KEY AUTOINCREMENT, VoyageType TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimDepartureDate (id integer PRIMARY KEY AUTOINCREMENT, DepartureDate TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimTour (id integer PRIMARY KEY AUTOINCREMENT, TourName TEXT NOT NULL UNIQUE, TourImg TEXT, TourMap TEXT);
-    CREATE TABLE IF NOT EXISTS dimDestination (id integer PRIMARY KEY AUTOINCREMENT, Destination TEXT NOT NULL UNIQUE);    
-    CREATE TABLE IF NOT EXISTS dimSourceMarket (id integer PRIMARY KEY AUTOINCREMENT, SourceMarket TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS Data_Explorer (
-                                    rDate_id integer NOT NULL,
-                                    ship_id integer NOT NULL,
-                                    cat_id integer NOT NULL,
-                                    type_id integer NOT NULL,
-                                    dep_id integer NOT NULL,
-                                    tour_id integer NO NULL,
-                                    dest_id integer NOT NULL,
-                                    source_id integer NOT NULL,
-                                    price real,
-                                    FOREIGN KEY (rDate_id) references dimReportDate(id),
-                                    FOREIGN KEY (ship_id) references dimShips(id),
-                                    FOREIGN KEY (cat_id) references dimCabinCategory(id),
-                                    FOREIGN KEY (type_id) references dimVoyage(id),
-                                    FOREIGN KEY (dep_id) references dimDepartureDate(id),
-                                    FOREIGN KEY (tour_id) references dimTour(id),
-                                    FOREIGN KEY (dest_id) references dimDestination(id),
-                                    FOREIGN KEY (source_id) references dimSourceMarket(id),
-                                    PRIMARY KEY (rDate_id, ship_id, cat_id, type_id, dep_id, tour_id, dest_id, source_id))
-                                    ''')
-            self.connection.commit()
-            return self.connection, self.cr
-        except:
-            pass
+        """
+        tours = [[(i, i)] for i in range(len(self.travel_response['voyages']))]
+        for i in range(len(tours)):
+            if self.resume and self.checkpoints.done(i, '', '', ''):
+                continue
+            try:
+                self.tour_page(i)
+            except Exception:
+                # The worker requests it again and records the failure
+                pass
+        self.sink.close()
+        fails, incomplete = sharding.run(self, tours, processes)
+        self.fails.extend(fails)
+        self.incomplete.extend(incomplete)
+        self.open_storage()
+        if self.storage_mode == 'delta':
+            # The writer process stored the rows, close_unseen() closes what it didn't see on this report date
+            self.facts.rDate_id = self.dims.ids['dimReportDate'].get(self.curDate)
+
+    def run_task(self, i):
+        """Worker side of scrape_sharded()"""
+        self.scrape_tour(i)
+
+    def __getstate__(self):
+        """The sqlite connection and everything built on it stays in the process that opened it"""
+        state = self.__dict__.copy()
+        for name in ('connection', 'cr', 'dims', 'facts', 'star', 'sink'):
+            state.pop(name, None)
+        return state
+
+    def start_day(self, report_date):
+        """Scheduler mode (see scheduler.py): (re)opens the storage for report date report_date.
+
+        The scheduler decides what is refreshed, so nothing is skipped as
+        already done. The gateways and the tour list are fetched again once
+        per report date.
 
+        """
+        if getattr(self, 'connection', None) is not None:
+            self.sink.close()
+        self.startdate(report_date)
+        self.client.metrics = self.metrics
+        self.resume = False
+        self.gateways = {}
+        self.tours = {}
+        self.open_storage()
+        try:
+            self.load_tours()
+        except Exception as error:
+            # Retried by the first refresh()
+            self.metrics.failure('travelfilter', error)
 
-    def scraper(self):
-        """Scrapes the data from the API"""
-#        with open('OOP_Price-{}.csv'.format(datetime.datetime.today().strftime("%Y-%m-%d")), 'w') as f:
-#            self.initiate_writer(f)
-        self.sql3_storage()
-        self.startdate()
+    def load_tours(self):
+        """Fetches the tour list, self.tours maps tour names to their index in it"""
         self.travelfilter_response()
-        for i in range(len(self.travel_response['voyages'])): # number of tours from travelfilter_response()
-                self.initial_response(i)
-                try:
-                    self.travel_codes()
-                    self.sold_out_check(i)
-                    for code in self.codes:  # from travel_codes()
-                        for m in self.markets:
-                            try:
-                                self.gateways_response(code)
-                                self.grouped_response(code,m)
-                                for item in self.group_response["calendar"]: # loops through all dates from grouped_response() on each code
-                                    if item["voyages"] is None:
-                                        if self.sold_out:
-                                            continue
-                                    self.get_quote(item)
-                                    for q in self.quote['categoryPrices']:
-                                        try:
-                                            self.parse_and_store(q)
-                                        except Exception:
-                                            continue
-#                                    self.quote_writer(i, code, item)
-                            except Exception:
-                                continue
-                except Exception:
-                    continue
-        self.connection.close()
+        self.tours = dict((voyage['name'], i) for i, voyage in enumerate(self.travel_response['voyages']))
+        return self.tours
+
+    def work_items(self, months):
+        """Scheduler mode: (tour name, market, month) work items.
+
+        One item per departure month ('YYYY-MM') with a current price, within
+        this month and the months-1 following ones, plus one item per listed
+        tour and market with month None covering all of its dates, which
+        finds new departures.
+
+        """
+        year, month = divmod(self.curYear * 12 + self.curMonth - 1 + months, 12)
+        current = 'Data_Explorer_Latest' if self.storage_mode != 'delta' else '(SELECT * FROM Data_Explorer_Delta WHERE validTo_id IS NULL)'
+        cr = self.connection.execute('''
+    SELECT DISTINCT t.TourName, m.SourceMarket, substr(d.DepartureDate, 1, 7)
+    FROM {} f
+    JOIN dimTour t ON t.id = f.tour_id
+    JOIN dimSourceMarket m ON m.id = f.source_id
+    JOIN dimDepartureDate d ON d.id = f.dep_id
+    WHERE substr(d.DepartureDate, 1, 7) >= ? AND substr(d.DepartureDate, 1, 7) < ?;'''.format(current),
+                                     (self.curDate[:7], '{:04d}-{:02d}'.format(year, month + 1)))
+        for tour, market, departure_month in cr.fetchall():
+            yield tour, market, departure_month
+        for tour in self.tours:
+            for m in self.markets:
+                yield tour, m, None
+
+    def refresh(self, tour, market, month):
+        """Scheduler mode: scrapes one tour in one market, only month ('YYYY-MM') if given.
+
+        Returns False if the tour is no longer listed.
+
+        """
+        if not self.tours:
+            self.load_tours()
+        if tour not in self.tours:
+            return False
+        self.tour_page(self.tours[tour])
+        for code in self.codes:
+            self.scrape_code(code, market, month)
+        return True
+
+    def price_history(self, tour, market, month, since):
+        """Scheduler mode: (key, report date, price) of one tour in one market reported since the
+        report date since, in month if given, ordered by key and report date"""
+        table = 'Data_Explorer_Delta_Snapshot' if self.storage_mode == 'delta' else 'Data_Explorer'
+        cr = self.connection.execute('''
+    SELECT f.ship_id, f.cat_id, f.type_id, f.dep_id, f.dest_id, r.ReportDate, f.price
+    FROM {} f
+    JOIN dimReportDate r ON r.id = f.rDate_id
+    JOIN dimDepartureDate d ON d.id = f.dep_id
+    JOIN dimTour t ON t.id = f.tour_id
+    JOIN dimSourceMarket m ON m.id = f.source_id
+    WHERE t.TourName = :tour AND m.SourceMarket = :market AND r.ReportDate >= :since AND (:month IS NULL OR substr(d.DepartureDate, 1, 7) = :month)
+    ORDER BY f.ship_id, f.cat_id, f.type_id, f.dep_id, f.dest_id, r.ReportDate;'''.format(table), {'tour': tour, 'market': market, 'since': since, 'month': month})
+        return ((row[:-2], row[-2], row[-1]) for row in cr)
+
+    def fail(self, stage, error, work):
+        """Records failed work, queued for retry_fails() only if a request failed.
+
+        Errors raised while handling a response (a calendar date without
+        voyages on a tour that is not sold out, say) come back on every try,
+        so they are kept in self.incomplete instead; see client.TRANSIENT.
+
+        """
+        self.metrics.failure(stage, error)
+        if isinstance(error, TRANSIENT):
+            self.fails.append(work)
+        else:
+            self.incomplete.append(work)
+
+    def retry_fails(self):
+        """Drains the retry queue, work that still fails stays in self.fails"""
+        for _ in range(self.retry_rounds):
+            queue, self.fails = self.fails, []
+            tours = {}
+            for i, code, m in queue:
+                tours.setdefault(i, []).append((code, m))
+            for i, pairs in tours.items():
+                self.scrape_tour(i, None if (None, None) in pairs else pairs)
+
 if __name__ == '__main__':
+    import argparse
+    PARSER = argparse.ArgumentParser(description='Scrapes Hurtigruten Explorer prices into Pricing.db')
+    PARSER.add_argument('--start', help='report date (y-m-d), defaults to today')
+    PARSER.add_argument('--replay', action='store_true', help='rebuild from the response cache, no network calls')
+    PARSER.add_argument('--metrics', help='directory to write explorer.json and explorer.prom run metrics to')
+    PARSER.add_argument('--compact', action='store_true', help='create a new database in the compact format')
+    PARSER.add_argument('--csv', help='also append the rows to this CSV file')
+    PARSER.add_argument('--ndjson', help='also append the rows to this NDJSON file')
+    PARSER.add_argument('--parquet', help='also write the rows to this Parquet dataset directory')
+    ARGS = PARSER.parse_args()
     SCRAPER = HurtigrutenAPI()
-    SCRAPER.scraper()
\ No newline at end of file
+    SCRAPER.compact = ARGS.compact
+    SCRAPER.exports = sinks.exports(ARGS.csv, ARGS.ndjson, ARGS.parquet)
+    if ARGS.metrics:
+        SCRAPER.metrics = Metrics('explorer')
+    try:
+        SCRAPER.scraper(ARGS.start, replay=ARGS.replay)
+    finally:
+        if ARGS.metrics:
+            SCRAPER.metrics.write(ARGS.metrics)
\ No newline at end of file
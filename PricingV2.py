@@ -1,20 +1,120 @@
-import requests
 import json
-import sqlite3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from cache import ResponseCache
+from client import TRANSIENT, HttpClient
+from metrics import DISABLED, Metrics
+import parsing
+import planner
+import sharding
+import sinks
+from storage import Checkpoints, StarSchema
+
+#One Availability request: the month searched from, the market and the route
+Cell = namedtuple('Cell', ['reqDate', 'market', 'fromPort', 'toPort'])
 
 class HRGCoastalPScraper():
-    
+    #Dimension tables of the star schema and their value column
+    DIMENSIONS = {'dimReportDate': 'ReportDate', 'dimShips': 'ShipCode', 'dimCabinCategory': 'Category',
+                  'dimVoyage': 'VoyageType', 'dimDepartureDate': 'DepartureDate', 'dimDeparturePorts': 'PortName',
+                  'dimArrivalPorts': 'PortName', 'dimSourceMarket': 'SourceMarket'}
+    FACT_COLUMNS = ['rDate_id', 'ship_id', 'cat_id', 'type_id', 'dep_id', 'dport_id', 'aport_id', 'source_id', 'occupancy', 'viaKKN', 'price']
+    #Tables of the scraper, formatted with storage.schema()
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS dimReportDate (id {day_id}, ReportDate TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimShips (id integer PRIMARY KEY AUTOINCREMENT, ShipCode TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimCabinCategory (id integer PRIMARY KEY AUTOINCREMENT, Category TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimVoyage (id integer PRIMARY KEY AUTOINCREMENT, VoyageType TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimDepartureDate (id {day_id}, DepartureDate TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimDeparturePorts (id integer PRIMARY KEY AUTOINCREMENT, PortName TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimArrivalPorts (id integer PRIMARY KEY AUTOINCREMENT, PortName TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS dimSourceMarket (id integer PRIMARY KEY AUTOINCREMENT, SourceMarket TEXT NOT NULL UNIQUE);
+    CREATE TABLE IF NOT EXISTS Data (
+                                    rDate_id integer NOT NULL,
+                                    ship_id integer NOT NULL,
+                                    cat_id integer NOT NULL,
+                                    type_id integer NOT NULL,
+                                    dep_id integer NOT NULL,
+                                    dport_id integer NO NULL,
+                                    aport_id integer NOT NULL,
+                                    source_id integer NOT NULL,
+                                    occupancy {value},
+                                    viaKKN {value},
+                                    price {value},
+                                    FOREIGN KEY (rDate_id) references dimReportDate(id),
+                                    FOREIGN KEY (ship_id) references dimShips(id),
+                                    FOREIGN KEY (cat_id) references dimCabinCategory(id),
+                                    FOREIGN KEY (type_id) references dimVoyage(id),
+                                    FOREIGN KEY (dep_id) references dimDepartureDate(id),
+                                    FOREIGN KEY (dport_id) references dimDeparturePorts(id),
+                                    FOREIGN KEY (aport_id) references dimArrivalPorts(id),
+                                    FOREIGN KEY (source_id) references dimSourceMarket(id),
+                                    PRIMARY KEY ({key})){rowid};
+    CREATE TABLE IF NOT EXISTS Data_Latest (
+                                    rDate_id integer NOT NULL,
+                                    ship_id integer NOT NULL,
+                                    cat_id integer NOT NULL,
+                                    type_id integer NOT NULL,
+                                    dep_id integer NOT NULL,
+                                    dport_id integer NOT NULL,
+                                    aport_id integer NOT NULL,
+                                    source_id integer NOT NULL,
+                                    occupancy {value},
+                                    viaKKN {value},
+                                    price {value},
+                                    PRIMARY KEY (dep_id, ship_id, cat_id, type_id, dport_id, aport_id, source_id)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS Data_departure ON Data (dep_id, ship_id, rDate_id);
+    {market_index}
+    CREATE INDEX IF NOT EXISTS Data_Latest_market ON Data_Latest (source_id, cat_id);
+    PRAGMA user_version = {version};
+                                    '''
+
     def __init__(self):
         self.main='https://www.hurtigruten.com'
         self.url='https://api.hurtigruten.com:443/api/Availability'
         self.headers = {'content-type': 'application/json'}
+        #Pooled connections, at most 20 requests/s per host, backoff retries on 429/5xx.
+        #Every response is also kept in the raw-response cache for 30 days so runs can be replayed:
+        self.client = HttpClient(rate=20, cache=ResponseCache('C:\\Users\\H520139\\.spyder-py3\\HRG\\DBs\\cache'))
+        #Where sql3_storage() opens the database:
+        self.location = 'C:\\Users\\H520139\\.spyder-py3\\HRG\\DBs\\'
+        self.dbname = 'Pricing.db'
         #How far will data be gathered (y-m-d):
         self.endDate = datetime(2021, 4, 1)
         self.DPs = ['BGO', 'KKN']
         self.APs = ['BGO', 'KKN', 'TRD']
         self.markets = ['NO', 'FR', 'DE', 'UK', 'US']
+        self.bookingSource = 'TDL_B2C_NO'
+        self.viaKKN = True
+        #Number of Availability requests in flight at once, 1 keeps the old sequential behaviour:
+        self.workers = 1
+        #Plan the Availability windows of sequential runs from the dates earlier responses covered
+        #and skip routes found empty in a market, instead of requesting every month (see planner.py).
+        #Off by default: the concurrent and sharded modes store the same database as a run of the grid:
+        self.plan = False
+        #Fact rows are written once per API response, or every batch_size rows if set:
+        self.batch_size = None
+        self.wal = False
+        #Parse Availability responses incrementally with ijson instead of decoding them at once:
+        self.incremental = False
+        #'snapshot' writes the full price grid to Data every run, 'delta' only writes changes to Data_Delta:
+        self.storage_mode = 'snapshot'
+        #Create a new database in the compact format (see storage.py), an existing one keeps its format:
+        self.compact = False
+        #Export sinks (see sinks.py) every stored row is also written to, on threads of their own:
+        self.exports = []
+        #Cells whose request failed, retried at the end of the run for retry_rounds rounds:
         self.fails = []
+        self.retry_rounds = 2
+        #Cells that failed without being queued for a retry, the run is incomplete if there are any:
+        self.incomplete = []
+        #Skip cells already completed by an earlier run for the same report date:
+        self.resume = True
+        #Set in worker processes of scrape_sharded(), rows are sent to the writer over it:
+        self.queue = None
+        #Stage timings and counters of a run, set to a metrics.Metrics to record them:
+        self.metrics = DISABLED
     
     def startdate(self, start=None):
         if start is None:
@@ -39,47 +139,17 @@ class HRGCoastalPScraper():
         self.reqDate = datetime(self.dateyear, self.datemonth, 1)
         return self.reqDate
 
-    def sql3_storage(self, location='C:\\Users\\H520139\\.spyder-py3\\HRG\\DBs\\', dbname='Pricing.db'):
-        self.location = location
-        self.dbname = dbname
-        self.connection = sqlite3.connect(location+dbname)
-        self.cr = self.connection.cursor()
-        try:
-            self.cr.executescript('''
-    CREATE TABLE IF NOT EXISTS dimReportDate (id integer PRIMARY KEY AUTOINCREMENT, ReportDate TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimShips (id integer PRIMARY KEY AUTOINCREMENT, ShipCode TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimCabinCategory (id integer PRIMARY KEY AUTOINCREMENT, Category TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimVoyage (id integer PRIMARY KEY AUTOINCREMENT, VoyageType TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimDepartureDate (id integer PRIMARY KEY AUTOINCREMENT, DepartureDate TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimDeparturePorts (id integer PRIMARY KEY AUTOINCREMENT, PortName TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimArrivalPorts (id integer PRIMARY KEY AUTOINCREMENT, PortName TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS dimSourceMarket (id integer PRIMARY KEY AUTOINCREMENT, SourceMarket TEXT NOT NULL UNIQUE);
-    CREATE TABLE IF NOT EXISTS Data (
-                                    rDate_id integer NOT NULL,
-                                    ship_id integer NOT NULL,
-                                    cat_id integer NOT NULL,
-                                    type_id integer NOT NULL,
-                                    dep_id integer NOT NULL,
-                                    dport_id integer NO NULL,
-                                    aport_id integer NOT NULL,
-                                    source_id integer NOT NULL,
-                                    occupancy real,
-                                    viaKKN real,
-                                    price real,
-                                    FOREIGN KEY (rDate_id) references dimReportDate(id),
-                                    FOREIGN KEY (ship_id) references dimShips(id),
-                                    FOREIGN KEY (cat_id) references dimCabinCategory(id),
-                                    FOREIGN KEY (type_id) references dimVoyage(id),
-                                    FOREIGN KEY (dep_id) references dimDepartureDate(id),
-                                    FOREIGN KEY (dport_id) references dimDeparturePorts(id),
-                                    FOREIGN KEY (aport_id) references dimArrivalPorts(id),
-                                    FOREIGN KEY (source_id) references dimSourceMarket(id),
-                                    PRIMARY KEY (rDate_id, ship_id, cat_id, type_id, dep_id, dport_id, aport_id, source_id))
-                                    ''')
-            self.connection.commit()
-            return self.connection, self.cr
-        except:
-            pass
+    def sql3_storage(self, location=None, dbname=None):
+        #Defaults to the location and dbname set in __init__
+        self.location = location or self.location
+        self.dbname = dbname or self.dbname
+        self.star = StarSchema(self.location+self.dbname, self.SCHEMA, 'Data', self.DIMENSIONS, self.FACT_COLUMNS, mode=self.storage_mode,
+                               compact=self.compact, wal=self.wal, batch_size=self.batch_size, metrics=self.metrics)
+        self.connection, self.cr, self.compact = self.star.connection, self.star.cr, self.star.compact
+        self.dims, self.facts = self.star.dims, self.star.facts
+        #Rows are stored in the star schema on this thread and handed to the export sinks, see sinks.py
+        self.sink = sinks.FanOut([self.star] + self.exports)
+        return self.connection, self.cr
 
     def query(self, fromPort, toPort, market, bookingSource="TDL_B2C_NO", viaKKN=True):
         self.fromPort = fromPort
@@ -87,71 +157,282 @@ class HRGCoastalPScraper():
         self.viaKKN = viaKKN
         self.bookingSource = bookingSource
         self.market = market
-        self.payload = {"currencyCode": "NOK","quoteId": "","fromPort": str(self.fromPort),"toPort": str(self.toPort),"isViaKirkenes": self.viaKKN,"searchFromDateTime": str(self.reqDate),"cabins": [{"passengers": [{"ageCategory": "ADULT","guestType": "REGULAR"},{"ageCategory": "ADULT","guestType": "REGULAR"}]}],"bookingSourceCode": str(self.bookingSource),"marketCode": str(self.market),"languageCode": "en"}
-        self.response_data = requests.post(self.url,data = json.dumps(self.payload), headers= self.headers)
+        self.payload = self.build_payload(Cell(self.reqDate, self.market, self.fromPort, self.toPort))
+        self.response_data = self.client.post(self.url, 'availability', data = json.dumps(self.payload), headers= self.headers)
         self.json_results = self.response_data.json()
         return self.json_results
 
-    def parse_and_store(self):
-        self.occupancy = len(self.payload['cabins'][0]['passengers'])
-        for date in self.json_results['calendar']:
-            if date['voyages'] == None:
-                continue
-            for sail in date['voyages']:
-                if sail['categoryPrices'] == None:
+    def build_payload(self, cell):
+        """Availability request body for one cell of the month x market x route grid"""
+        return {"currencyCode": "NOK","quoteId": "","fromPort": str(cell.fromPort),"toPort": str(cell.toPort),"isViaKirkenes": self.viaKKN,"searchFromDateTime": str(cell.reqDate),"cabins": [{"passengers": [{"ageCategory": "ADULT","guestType": "REGULAR"},{"ageCategory": "ADULT","guestType": "REGULAR"}]}],"bookingSourceCode": str(self.bookingSource),"marketCode": str(cell.market),"languageCode": "en"}
+
+    def fetch(self, cell):
+        """Thread safe version of query(): nothing is read from or written to self per request"""
+        response = self.client.post(self.url, 'availability', data=json.dumps(self.build_payload(cell)), headers=self.headers)
+        if self.incremental and parsing.ijson is not None:
+            #The body is left for rows() to parse incrementally
+            return response.content
+        with self.metrics.time('stage_seconds', stage='decode'):
+            return response.json()
+
+    def parse_and_store(self, json_results=None, cell=None, dates=None):
+        #Without arguments the response and its context are read off self as set by query()
+        if json_results is None:
+            json_results = self.json_results
+        if cell is None:
+            cell = Cell(self.reqDate, self.market, self.fromPort, self.toPort)
+        rows = self.rows(json_results, cell, dates)
+        if self.metrics.enabled:
+            #rows() is lazy, the calendar is walked (and in incremental mode parsed) first so parsing isn't timed as storing.
+            #Without metrics the rows are streamed into the sink
+            with self.metrics.time('stage_seconds', stage='parse'):
+                rows = list(rows)
+        with self.metrics.time('stage_seconds', stage='store'):
+            self.store_rows(rows)
+        self.json_results = None
+        if not self.batch_size:
+            self.sink.flush()
+
+    def rows(self, json_results, cell, dates=None):
+        """Yields the available prices of one Availability response as parsing.CoastalPrice rows.
+        json_results is the decoded response or, in incremental mode, its body.
+        The dates of its calendar are appended to dates if given"""
+        occupancy = len(self.build_payload(cell)['cabins'][0]['passengers'])
+        days = parsing.calendar(json_results)
+        if dates is not None:
+            days = planner.dates_of(days, dates)
+        return parsing.coastal_rows(days, self.curDate, cell.fromPort, cell.toPort, cell.market, occupancy, self.viaKKN)
+
+    def store_rows(self, rows):
+        #Writes the rows to the star schema and the export sinks
+        self.sink.write(rows)
+
+    def routes(self):
+        #(departure port, arrival port) pairs requested, in the order of the original nested loops
+        for dp in self.DPs:
+            for ap in self.APs:
+                if dp == 'KKN' and ap == 'KKN':
                     continue
-                for categ in sail['categoryPrices']:
-                    if categ['available'] == True:
-                        self.cr.execute('INSERT OR IGNORE INTO dimReportDate(ReportDate) VALUES (?);', (self.curDate,))
-                        self.cr.execute('SELECT id FROM dimReportDate WHERE ReportDate = ?;', (self.curDate, ))
-                        self.rDate_id = self.cr.fetchone()[0]
-                        self.cr.execute('INSERT OR IGNORE INTO dimShips(ShipCode) VALUES (?);', (sail['ship']['shipCode'], ))
-                        self.cr.execute('SELECT id FROM dimShips WHERE shipCode = ?;', (sail['ship']['shipCode'], ))
-                        self.ship_id = self.cr.fetchone()[0]
-                        self.cr.execute('INSERT OR IGNORE INTO dimCabinCategory(Category) VALUES (?);', (categ['code'], ))
-                        self.cr.execute('SELECT id FROM dimCabinCategory WHERE Category = ?;', (categ['code'], ))
-                        self.cat_id = self.cr.fetchone()[0]
-                        self.cr.execute('INSERT OR IGNORE INTO dimVoyage(VoyageType) VALUES (?);', (sail['voyageType'], ))
-                        self.cr.execute('SELECT id FROM dimVoyage WHERE VoyageType = ?;', (sail['voyageType'], ))
-                        self.type_id = self.cr.fetchone()[0]
-                        self.cr.execute('INSERT OR IGNORE INTO dimDepartureDate(DepartureDate) VALUES (?);', (date['date'], ))
-                        self.cr.execute('SELECT id FROM dimDepartureDate WHERE DepartureDate = ?;', (date['date'], ))
-                        self.dep_id = self.cr.fetchone()[0]
-                        self.cr.execute('INSERT OR IGNORE INTO dimDeparturePorts(PortName) VALUES (?);', (self.fromPort, ))
-                        self.cr.execute('SELECT id FROM dimDeparturePorts WHERE PortName = ?;', (self.fromPort, ))
-                        self.dport_id = self.cr.fetchone()[0]
-                        self.cr.execute('INSERT OR IGNORE INTO dimArrivalPorts(PortName) VALUES (?);', (self.toPort, ))
-                        self.cr.execute('SELECT id FROM dimArrivalPorts WHERE PortName = ?;', (self.toPort, ))
-                        self.aport_id = self.cr.fetchone()[0]                        
-                        self.cr.execute('INSERT OR IGNORE INTO dimSourceMarket(SourceMarket) VALUES (?);', (self.market, ))
-                        self.cr.execute('SELECT id FROM dimSourceMarket WHERE SourceMarket = ?;', (self.market, ))
-                        self.source_id = self.cr.fetchone()[0]
-                        
-                        self.cr.execute('INSERT OR IGNORE INTO Data(rdate_id, ship_id, cat_id, type_id, dep_id, dport_id, aport_id, source_id, occupancy, viaKKN, price) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);', (self.rDate_id, self.ship_id, self.cat_id, self.type_id, self.dep_id, self.dport_id, self.aport_id, self.source_id, self.occupancy, self.viaKKN, categ['price']['amount']))
-                        self.connection.commit()
-#                        print ("Inserted:", date['date'], sail['ship']['shipCode'],self.fromPort, self.toPort, self.market, categ['code'], categ['price']['amount'])
-                        self.json_results = None
-
-    def scrape(self, start=None):
-        self.startdate(start)
-        self.sql3_storage()
+                if dp == 'KKN' and ap == 'TRD':
+                    continue
+                yield dp, ap
+
+    def cells(self):
+        #Walks the grid in the same order as the original nested loops
         while self.reqDate < self.endDate:
             for m in self.markets:
-                for dp in self.DPs:
-                    for ap in self.APs:
-                        if dp == 'KKN' and ap == 'KKN':
-                            continue
-                        if dp == 'KKN' and ap == 'TRD':
-                            continue
-                        try:
-                            self.query(dp, ap, m)
-                            self.parse_and_store()
-                        except:
-                            self.fails.append(str(self.reqDate) + str(dp) + str(ap) + str(m))
+                for dp, ap in self.routes():
+                    yield Cell(self.reqDate, m, dp, ap)
             self.month_increment(self.reqDate)
-        self.connection.close()
+
+    def pending_cells(self):
+        #Cells of the grid not completed yet for this report date, all of them unless resuming
+        for cell in self.cells():
+            if not (self.resume and self.checkpoints.done('{:%Y-%m-%d}'.format(cell.reqDate), cell.market, cell.fromPort, cell.toPort)):
+                yield cell
+
+    def checkpoint(self, cell):
+        self.checkpoints.mark('{:%Y-%m-%d}'.format(cell.reqDate), cell.market, cell.fromPort, cell.toPort)
+
+    def open_storage(self):
+        self.sql3_storage()
+        self.checkpoints = Checkpoints(self.connection, 'coastal', self.curDate)
+
+    def scrape(self, start=None, workers=None, replay=False, processes=None):
+        #With replay=True Pricing.db is rebuilt from the response cache without any network calls,
+        #start should then be the report date of the run being replayed.
+        #With processes=N the grid is sharded over N worker processes, see scrape_sharded()
+        self.startdate(start)
+        self.client.metrics = self.metrics
+        self.open_storage()
+        self.client.offline = replay
+        if not replay and self.client.cache is not None:
+            self.client.cache.evict()
+        if workers is not None:
+            self.workers = workers
+        if processes:
+            self.scrape_sharded(processes)
+        elif self.workers > 1:
+            self.scrape_concurrent()
+        elif self.plan:
+            self.scrape_planned()
+        else:
+            for cell in self.pending_cells():
+                try:
+                    self.parse_and_store(self.fetch(cell), cell)
+                    self.checkpoint(cell)
+                except Exception as error:
+                    self.fail('cell', error, cell)
+        self.retry_fails()
+        self.sink.flush()
+        if self.storage_mode == 'delta' and not self.fails and not self.incomplete:
+            self.facts.close_unseen()
+        self.sink.close()
+
+    def scrape_planned(self):
+        #Walks one route and market at a time through the windows of a planner.WindowPlanner,
+        #every request is told the dates its response covered before the next one is planned
+        self.planner = planner.WindowPlanner(self.connection, self.curDate, self.endDate, self.resume, metrics=self.metrics)
+        for m in self.markets:
+            for dp, ap in self.routes():
+                lane = (dp, ap, m)
+                for reqDate in self.planner.windows(lane, self.reqDate):
+                    cell = Cell(reqDate, m, dp, ap)
+                    dates = []
+                    try:
+                        self.parse_and_store(self.fetch(cell), cell, dates)
+                        self.planner.record(lane, reqDate, dates)
+                        self.checkpoint(cell)
+                    except Exception as error:
+                        self.fail('cell', error, cell)
+
+    def scrape_concurrent(self):
+        #Requests run on a thread pool, responses are stored on this thread in grid order
+        #since the sqlite connection can't be shared between threads
+        cells = list(self.pending_cells())
+        if self.client.pool_size < self.workers:
+            self.client.mount(self.workers)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self.fetch, cell) for cell in cells]
+            for cell, future in zip(cells, futures):
+                try:
+                    self.parse_and_store(future.result(), cell)
+                    self.checkpoint(cell)
+                except Exception as error:
+                    self.fail('cell', error, cell)
+
+    def scrape_sharded(self, processes, months=3):
+        #Shards the pending cells by market and blocks of months over a pool of worker processes.
+        #Workers fetch and parse, a single writer process owns the sqlite connection and stores
+        #the rows in grid order, so the database ends up the same as after a sequential run
+        cells = list(self.pending_cells())
+        blocks = sorted(set(cell.reqDate for cell in cells))
+        shards = {}
+        for seq, cell in enumerate(cells):
+            shards.setdefault((cell.market, blocks.index(cell.reqDate) // months), []).append((seq, cell))
+        self.sink.close()
+        fails, incomplete = sharding.run(self, list(shards.values()), processes)
+        self.fails.extend(fails)
+        self.incomplete.extend(incomplete)
+        self.open_storage()
+        if self.storage_mode == 'delta':
+            #The writer process stored the rows, close_unseen() closes what it didn't see on this report date
+            self.facts.rDate_id = self.dims.ids['dimReportDate'].get(self.curDate)
+
+    def run_task(self, cell):
+        #Worker side of scrape_sharded(): one cell, parsed rows go to the writer process as a list
+        try:
+            json_results = self.fetch(cell)
+            with self.metrics.time('stage_seconds', stage='parse'):
+                rows = list(self.rows(json_results, cell))
+            self.emit(cell, rows)
+        except Exception as error:
+            self.fail('cell', error, cell)
+
+    def emit(self, cell, rows):
+        #In a worker process the rows are queued for the writer, in the writer they are stored
+        if self.queue is not None:
+            self.queue.put((self.task, cell, rows))
+            return
+        with self.metrics.time('stage_seconds', stage='store'):
+            self.store_rows(rows)
+        self.checkpoint(cell)
+        if not self.batch_size:
+            self.sink.flush()
+
+    def __getstate__(self):
+        #The sqlite connection and everything built on it stays in the process that opened it
+        state = self.__dict__.copy()
+        for name in ('connection', 'cr', 'dims', 'facts', 'star', 'sink', 'planner'):
+            state.pop(name, None)
+        return state
+
+    def start_day(self, report_date):
+        #Scheduler mode (see scheduler.py): (re)opens the storage for report date report_date.
+        #The scheduler decides what is refreshed, so nothing is skipped as already done
+        if getattr(self, 'connection', None) is not None:
+            self.sink.close()
+        self.startdate(report_date)
+        self.client.metrics = self.metrics
+        self.resume = False
+        self.open_storage()
+
+    def work_items(self, months):
+        #Scheduler mode: (route, market, 'YYYY-MM') of every cell in this month and the months-1 following ones
+        reqDate = datetime(self.curYear, self.curMonth, 1)
+        for _ in range(months):
+            for m in self.markets:
+                for route in self.routes():
+                    yield route, m, '{:%Y-%m}'.format(reqDate)
+            reqDate = self.month_increment(reqDate)
+
+    def refresh(self, route, market, month):
+        #Scheduler mode: scrapes the cell of one route, market and month for the current report date
+        cell = Cell(datetime.strptime(month, '%Y-%m'), market, route[0], route[1])
+        self.parse_and_store(self.fetch(cell), cell)
+        self.checkpoint(cell)
+        return True
+
+    def price_history(self, route, market, month, since):
+        #Scheduler mode: (key, report date, price) of the departures in month of one route and market
+        #reported since the report date since, ordered by key and report date
+        table = 'Data_Delta_Snapshot' if self.storage_mode == 'delta' else 'Data'
+        cr = self.connection.execute('''
+    SELECT f.ship_id, f.cat_id, f.type_id, f.dep_id, r.ReportDate, f.price
+    FROM {} f
+    JOIN dimReportDate r ON r.id = f.rDate_id
+    JOIN dimDepartureDate d ON d.id = f.dep_id
+    JOIN dimDeparturePorts dp ON dp.id = f.dport_id
+    JOIN dimArrivalPorts ap ON ap.id = f.aport_id
+    JOIN dimSourceMarket m ON m.id = f.source_id
+    WHERE m.SourceMarket = ? AND dp.PortName = ? AND ap.PortName = ? AND r.ReportDate >= ? AND substr(d.DepartureDate, 1, 7) = ?
+    ORDER BY f.ship_id, f.cat_id, f.type_id, f.dep_id, r.ReportDate;'''.format(table), (market, route[0], route[1], since, month))
+        return ((row[:-2], row[-2], row[-1]) for row in cr)
+
+    def fail(self, stage, error, cell):
+        #Records a failed cell, only queued for retry_fails() if the request itself failed (see client.TRANSIENT):
+        #a response that can't be parsed fails the same way every time and is kept in self.incomplete
+        self.metrics.failure(stage, error)
+        if isinstance(error, TRANSIENT):
+            self.fails.append(cell)
+        else:
+            self.incomplete.append(cell)
+
+    def retry_fails(self):
+        #Drains the retry queue, cells that still fail stay in self.fails
+        for _ in range(self.retry_rounds):
+            queue, self.fails = self.fails, []
+            for cell in queue:
+                try:
+                    self.parse_and_store(self.fetch(cell), cell)
+                    self.checkpoint(cell)
+                except Exception as error:
+                    self.fail('retry', error, cell)
 
 if __name__ == '__main__':
+    import argparse
+    PARSER = argparse.ArgumentParser(description='Scrapes Hurtigruten coastal prices into Pricing.db')
+    PARSER.add_argument('--start', help='report date (y-m-d), defaults to today')
+    PARSER.add_argument('--replay', action='store_true', help='rebuild from the response cache, no network calls')
+    PARSER.add_argument('--metrics', help='directory to write coastal.json and coastal.prom run metrics to')
+    PARSER.add_argument('--compact', action='store_true', help='create a new database in the compact format')
+    PARSER.add_argument('--plan', action='store_true', help='plan the Availability windows instead of requesting every month, see planner.py')
+    PARSER.add_argument('--csv', help='also append the rows to this CSV file')
+    PARSER.add_argument('--ndjson', help='also append the rows to this NDJSON file')
+    PARSER.add_argument('--parquet', help='also write the rows to this Parquet dataset directory')
+    ARGS = PARSER.parse_args()
     SCRAPER = HRGCoastalPScraper()
-    SCRAPER.scrape()
+    SCRAPER.compact = ARGS.compact
+    SCRAPER.plan = ARGS.plan
+    SCRAPER.exports = sinks.exports(ARGS.csv, ARGS.ndjson, ARGS.parquet)
+    if ARGS.metrics:
+        SCRAPER.metrics = Metrics('coastal')
+    try:
+        SCRAPER.scrape(ARGS.start, replay=ARGS.replay)
+    finally:
+        if ARGS.metrics:
+            SCRAPER.metrics.write(ARGS.metrics)
+    if getattr(SCRAPER, 'planner', None) is not None:
+        print('Availability requests: {requests} sent for a grid of {grid}, {saved_window} saved by window planning, '
+              '{saved_empty} by skipping {empty_lanes} empty routes'.format(**SCRAPER.planner.report))
 #print(o.fails)
@@ -0,0 +1,77 @@
+"""Times the coastal parse step on its own against fixture files.
+
+Usage: python benchmarks/bench_parse.py [--days N] [FIXTURE ...]
+
+FIXTURE is an Availability response body (.json) or an entry of the raw
+response cache (.json.gz). Without fixtures a synthetic response with
+--days calendar days is generated. Each fixture is parsed into
+parsing.CoastalPrice rows once with json (whole response decoded) and,
+if ijson is installed, once incrementally; peak memory is measured with
+tracemalloc.
+
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parsing
+
+
+def synthetic(days):
+    """Availability response body with a voyage per ship and 20 cabin categories per day"""
+    calendar = []
+    for day in range(days):
+        voyages = [{'ship': {'shipCode': ship}, 'voyageType': 'NORTHBOUND', 'voyageId': '{}{}'.format(ship, day),
+                    'categoryPrices': [{'code': 'C{:02d}'.format(c), 'available': random.random() > 0.2,
+                                        'price': {'amount': random.randint(5000, 90000) / 1.0, 'currencyCode': 'NOK'}}
+                                       for c in range(20)]}
+                   for ship in ('FRAM', 'VES', 'NOR')]
+        calendar.append({'date': '2021-{:02d}-{:02d}T00:00:00'.format(day // 28 % 12 + 1, day % 28 + 1), 'voyages': voyages})
+    return json.dumps({'calendar': calendar, 'quoteId': 'Q'}).encode('utf-8')
+
+
+def load(path):
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)['body'].encode('utf-8')
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def measure(name, parse, body):
+    tracemalloc.start()
+    t = time.perf_counter()
+    count = sum(1 for _ in parse(body))
+    elapsed = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{:<14} {:>9} rows {:>8.3f} s {:>12.0f} rows/s {:>9.1f} MiB peak'.format(name, count, elapsed, count / elapsed, peak / 2.0 ** 20))
+
+
+def rows(days):
+    return parsing.coastal_rows(days, '2020-10-01', 'BGO', 'KKN', 'NO', 2, True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=2000)
+    parser.add_argument('fixtures', nargs='*')
+    args = parser.parse_args()
+    bodies = [(path, load(path)) for path in args.fixtures] or [('synthetic', synthetic(args.days))]
+    for name, body in bodies:
+        print('{} ({:.1f} MiB)'.format(name, len(body) / 2.0 ** 20))
+        measure('json', lambda b: rows(parsing.calendar(json.loads(b))), body)
+        if parsing.ijson is not None:
+            measure('incremental', lambda b: rows(parsing.calendar(b)), body)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Times the dashboard queries on the fact table with and without secondary indexes, and on the latest-price table.
+
+Usage: python benchmarks/bench_queries.py [--rows N] [--dates N] [--repeat N] [--db PATH]
+
+Builds a synthetic Pricing.db through the coastal scraper's schema: --dates
+report dates with the same set of keys on each (about --rows fact rows
+in total). The queries are first timed with only the primary key index,
+then sql3_storage is run again on the filled database, which creates the
+secondary indexes and backfills Data_Latest, and they are timed again.
+
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PricingV2 import HRGCoastalPScraper
+
+SHIPS = 11
+CATEGORIES = 23
+MARKETS = 6
+SECONDARY_INDEXES = ['Data_departure', 'Data_market', 'Data_Latest_market']
+
+QUERIES = [
+    ('current price of departure on ship, Data', '''
+        SELECT cat_id, source_id, price FROM Data
+        WHERE dep_id = :dep AND ship_id = :ship
+          AND rDate_id = (SELECT max(rDate_id) FROM Data WHERE dep_id = :dep AND ship_id = :ship);'''),
+    ('current price of departure on ship, Latest', '''
+        SELECT cat_id, source_id, price FROM Data_Latest WHERE dep_id = :dep AND ship_id = :ship;'''),
+    ('categories of market on report date, Data', '''
+        SELECT cat_id, min(price), max(price) FROM Data WHERE source_id = :market AND rDate_id = :rdate GROUP BY cat_id;'''),
+    ('categories of market, Latest', '''
+        SELECT cat_id, min(price), max(price) FROM Data_Latest WHERE source_id = :market GROUP BY cat_id;'''),
+    ('price history of departure on ship, Data', '''
+        SELECT rDate_id, cat_id, price FROM Data WHERE dep_id = :dep AND ship_id = :ship AND cat_id = :cat ORDER BY rDate_id;'''),
+]
+
+
+def build(scraper, rows, dates):
+    """Fills the dimension and fact tables, returns the ids of every dimension used"""
+    departures = max(1, rows // dates // (SHIPS * CATEGORIES * MARKETS))
+    dims = scraper.dims
+    rdate_ids = [dims.id('dimReportDate', '2020-{:02d}-{:02d}'.format(d // 28 + 1, d % 28 + 1)) for d in range(dates)]
+    ship_ids = [dims.id('dimShips', 'MS{}'.format(s)) for s in range(SHIPS)]
+    cat_ids = [dims.id('dimCabinCategory', 'CAT{}'.format(c)) for c in range(CATEGORIES)]
+    market_ids = [dims.id('dimSourceMarket', 'M{}'.format(m)) for m in range(MARKETS)]
+    first = datetime.date(2021, 1, 1)
+    dep_ids = [dims.id('dimDepartureDate', str(first + datetime.timedelta(days=d))) for d in range(departures)]
+    type_id = dims.id('dimVoyage', 'NORTH')
+    dport_id = dims.id('dimDeparturePorts', 'BGO')
+    aport_id = dims.id('dimArrivalPorts', 'KKN')
+    scraper.connection.commit()
+    sql = 'INSERT INTO Data({}) VALUES ({});'.format(', '.join(scraper.FACT_COLUMNS), ', '.join('?' * len(scraper.FACT_COLUMNS)))
+    for n, rdate_id in enumerate(rdate_ids):
+        scraper.connection.executemany(sql, ((rdate_id, ship_id, cat_id, type_id, dep_id, dport_id, aport_id, market_id, 2, 1, 1000.0 + n + c)
+                                             for ship_id in ship_ids for c, cat_id in enumerate(cat_ids)
+                                             for dep_id in dep_ids for market_id in market_ids))
+        scraper.connection.commit()
+    return rdate_ids, ship_ids, cat_ids, market_ids, dep_ids
+
+
+def time_queries(connection, params, latest=True):
+    for name, sql in QUERIES:
+        if not latest and name.endswith('Latest'):
+            continue
+        t = time.perf_counter()
+        for p in params:
+            connection.execute(sql, p).fetchall()
+        elapsed = (time.perf_counter() - t) / len(params)
+        print('  {:<45} {:>10.3f} ms/query'.format(name, elapsed * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--dates', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=20, help='queries per variant, each with other random keys')
+    parser.add_argument('--db', help='keep the synthetic database at this path instead of a temporary directory')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        location, dbname = os.path.split(os.path.abspath(args.db)) if args.db else (tmp, 'bench.db')
+        if os.path.exists(os.path.join(location, dbname)):
+            os.remove(os.path.join(location, dbname))
+        scraper = HRGCoastalPScraper()
+        scraper.sql3_storage(location=location + os.sep, dbname=dbname)
+        for index in SECONDARY_INDEXES:
+            scraper.connection.execute('DROP INDEX {};'.format(index))
+        t = time.perf_counter()
+        rdate_ids, ship_ids, cat_ids, market_ids, dep_ids = build(scraper, args.rows, args.dates)
+        count = scraper.connection.execute('SELECT count(*) FROM Data;').fetchone()[0]
+        print('built {} fact rows in {:.1f} s'.format(count, time.perf_counter() - t))
+        rng = random.Random(0)
+        params = [{'dep': rng.choice(dep_ids), 'ship': rng.choice(ship_ids), 'cat': rng.choice(cat_ids),
+                   'market': rng.choice(market_ids), 'rdate': rdate_ids[-1]} for _ in range(args.repeat)]
+        # Full scans, a few queries are enough
+        print('primary key only:')
+        time_queries(scraper.connection, params[:max(1, args.repeat // 10)], latest=False)
+        scraper.connection.close()
+
+        scraper = HRGCoastalPScraper()
+        t = time.perf_counter()
+        scraper.sql3_storage(location=location + os.sep, dbname=dbname)
+        print('created indexes and backfilled {} latest prices in {:.1f} s'.format(
+            scraper.connection.execute('SELECT count(*) FROM Data_Latest;').fetchone()[0], time.perf_counter() - t))
+        print('secondary indexes:')
+        time_queries(scraper.connection, params)
+        scraper.connection.close()
+
+
+if __name__ == '__main__':
+    main()
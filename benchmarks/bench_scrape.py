@@ -0,0 +1,139 @@
+"""Runs both scrapers end to end against the local stub API and reports their throughput.
+
+Usage: python benchmarks/bench_scrape.py [--scraper coastal|explorer] [--latency MS]
+           [--months N] [--workers N] [--processes N] [--plan] [--rate N] [--no-cache] [--json PATH] [--metrics DIR]
+           [--days N] [--voyages N] [--categories N] [--tours N] [--codes N] [--dates N] [--page-kb N]
+
+Every run gets a fresh database and response cache in a temporary directory
+and runs in its own process, so the peak RSS reported is that of the run
+(and of its worker processes, for --processes). No request leaves the machine.
+With --metrics the per-stage breakdown of every run (see metrics.py) is
+written to DIR as well.
+
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stub_api
+from cache import ResponseCache
+from metrics import Metrics
+
+START = '2020-10-05'
+
+
+def peak_rss():
+    """Peak resident set size of this process and its waited-for children, in MB"""
+    if resource is None:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kB on Linux, bytes on macOS
+    return rss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+def scrape(kind, base, tmp, options, results):
+    """Child process: one end to end run of a scraper against the stub at base"""
+    if kind == 'coastal':
+        from PricingV2 import HRGCoastalPScraper
+        scraper = HRGCoastalPScraper()
+        start = datetime.strptime(START, '%Y-%m-%d')
+        months = start.month - 1 + options['months']
+        scraper.endDate = datetime(start.year + months // 12, months % 12 + 1, 1)
+        scraper.workers = options['workers']
+        scraper.plan = options['plan']
+        table = 'Data'
+    else:
+        from Explorer_pricescraper import HurtigrutenAPI
+        scraper = HurtigrutenAPI()
+        table = 'Data_Explorer'
+    stub_api.point(scraper, base)
+    scraper.location, scraper.dbname = tmp + os.sep, 'bench.db'
+    scraper.client.cache = None if options['no_cache'] else ResponseCache(os.path.join(tmp, 'cache'))
+    scraper.client.rate = options['rate']
+    if options['metrics']:
+        scraper.metrics = Metrics(kind)
+    t = time.perf_counter()
+    # The explorer scraper prints every row it stores
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if kind == 'coastal':
+            scraper.scrape(START, processes=options['processes'])
+        else:
+            scraper.scraper(START, processes=options['processes'])
+    wall = time.perf_counter() - t
+    if options['metrics']:
+        scraper.metrics.write(options['metrics'])
+    connection = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+    rows = connection.execute('SELECT count(*) FROM {};'.format(table)).fetchone()[0]
+    connection.close()
+    results.put({'wall': wall, 'rows': rows, 'fails': len(scraper.fails), 'peak_rss_mb': peak_rss()})
+
+
+def run(kind, server, options):
+    """Runs one scraper in a child process, returns its measurements"""
+    served = server.served()
+    results = multiprocessing.Queue()
+    with tempfile.TemporaryDirectory() as tmp:
+        child = multiprocessing.Process(target=scrape, args=(kind, server.base, tmp, options, results))
+        child.start()
+        result = results.get()
+        child.join()
+    result['scraper'] = kind
+    result['endpoints'] = dict((name, count - served.get(name, 0)) for name, count in server.served().items() if count > served.get(name, 0))
+    result['requests'] = sum(result['endpoints'].values())
+    result['requests_per_s'] = result['requests'] / result['wall']
+    result['rows_per_s'] = result['rows'] / result['wall']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scraper', action='append', choices=['coastal', 'explorer'], help='scraper to run, repeatable (default: both)')
+    parser.add_argument('--latency', type=float, default=20, help='milliseconds added to every stub response')
+    parser.add_argument('--months', type=int, default=3, help='months the coastal scraper requests')
+    parser.add_argument('--workers', type=int, default=1, help='coastal request threads')
+    parser.add_argument('--processes', type=int, help='shard over this many worker processes')
+    parser.add_argument('--plan', action='store_true', help='coastal: plan the Availability windows instead of requesting every month (see planner.py)')
+    parser.add_argument('--rate', type=float, help='requests/s per host, default unthrottled')
+    parser.add_argument('--no-cache', action='store_true', help='run without the response cache')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--metrics', help='directory to write the run metrics of each scraper to')
+    defaults = stub_api.Fixtures()
+    for name in ('days', 'voyages', 'categories', 'tours', 'codes', 'dates', 'page_kb'):
+        parser.add_argument('--' + name.replace('_', '-'), type=int, default=getattr(defaults, name), help='stub response size, see stub_api.Fixtures')
+    args = parser.parse_args()
+    fixtures = stub_api.Fixtures(args.latency / 1000.0, args.days, args.voyages, args.categories, args.tours, args.codes, args.dates, args.page_kb)
+    options = {'months': args.months, 'workers': args.workers, 'processes': args.processes, 'plan': args.plan, 'rate': args.rate, 'no_cache': args.no_cache,
+               'metrics': args.metrics}
+    server = stub_api.serve(fixtures)
+    results = []
+    try:
+        for kind in args.scraper or ['coastal', 'explorer']:
+            result = run(kind, server, options)
+            results.append(result)
+            print('{scraper:<9} {wall:>8.2f} s {requests:>7} requests {requests_per_s:>8.1f} req/s {rows:>9} rows {rows_per_s:>10.0f} rows/s'
+                  ' peak RSS {rss} fails {fails}'.format(rss='{:.0f} MB'.format(result['peak_rss_mb']) if result['peak_rss_mb'] else 'n/a', **result))
+    finally:
+        server.shutdown()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': dict(options, **vars(fixtures)), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
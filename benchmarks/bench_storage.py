@@ -0,0 +1,85 @@
+"""Compares fact-row insert rates of the per-row and buffered write paths.
+
+Usage: python benchmarks/bench_storage.py [--rows N] [--batch N] [--parquet]
+
+Each variant writes the same synthetic price rows through the coastal
+scraper's schema into a fresh database in a temporary directory. The
+export variants also write them to CSV and NDJSON (and Parquet) sinks;
+their time is that of the store loop, the time to drain the export threads
+at the end is shown separately.
+
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sinks
+from parsing import CoastalPrice
+from PricingV2 import HRGCoastalPScraper
+
+
+def synthetic_rows(n):
+    """Fact rows shaped like the ones parse_and_store produces"""
+    for k in range(n):
+        yield CoastalPrice('2020-10-01', 'MS{}'.format(k % 11), 'CAT{}'.format(k % 23), 'NORTH', '2021-{:02d}-{:02d}'.format(k // 28 % 12 + 1, k % 28 + 1),
+                           'BGO', 'KKN', 'NO', 2, True, 1000.0 + k)
+
+
+def per_row(scraper, rows):
+    """The original path: dimension lookups, one INSERT and one commit per row"""
+    cr = scraper.cr
+    for row in rows:
+        ids = []
+        for (table, column), value in zip(scraper.DIMENSIONS.items(), row):
+            cr.execute('INSERT OR IGNORE INTO {}({}) VALUES (?);'.format(table, column), (value, ))
+            cr.execute('SELECT id FROM {} WHERE {} = ?;'.format(table, column), (value, ))
+            ids.append(cr.fetchone()[0])
+        cr.execute('INSERT OR IGNORE INTO Data(rdate_id, ship_id, cat_id, type_id, dep_id, dport_id, aport_id, source_id, occupancy, viaKKN, price) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);', ids + list(row[8:]))
+        scraper.connection.commit()
+
+
+def buffered(scraper, rows):
+    """The sink path used by parse_and_store"""
+    scraper.store_rows(rows)
+    scraper.sink.flush()
+
+
+def run(name, writer, n, batch_size=None, wal=False, exports=()):
+    with tempfile.TemporaryDirectory() as tmp:
+        scraper = HRGCoastalPScraper()
+        scraper.batch_size = batch_size
+        scraper.wal = wal
+        scraper.exports = sinks.exports(*(os.path.join(tmp, 'bench.' + kind) if kind in exports else None for kind in ('csv', 'ndjson', 'parquet')))
+        scraper.sql3_storage(location=tmp + os.sep, dbname='bench.db')
+        t = time.perf_counter()
+        writer(scraper, list(synthetic_rows(n)))
+        elapsed = time.perf_counter() - t
+        count = scraper.connection.execute('SELECT count(*) FROM Data;').fetchone()[0]
+        t = time.perf_counter()
+        scraper.sink.close()
+        drain = time.perf_counter() - t
+    print('{:<28} {:>8} rows {:>8.2f} s {:>12.0f} rows/s{}'.format(name, count, elapsed, count / elapsed,
+                                                                  '  (+{:.2f} s drain)'.format(drain) if exports else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=5000)
+    parser.add_argument('--parquet', action='store_true', help='add a Parquet sink to the export variant, needs pyarrow')
+    args = parser.parse_args()
+    run('per-row commit', per_row, args.rows)
+    run('buffered, one flush', buffered, args.rows)
+    run('buffered, batch', buffered, args.rows, batch_size=args.batch)
+    run('buffered, batch, WAL', buffered, args.rows, batch_size=args.batch, wal=True)
+    exports = ('csv', 'ndjson', 'parquet') if args.parquet else ('csv', 'ndjson')
+    run('buffered, batch, exports', buffered, args.rows, batch_size=args.batch, exports=exports)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""Local stand-in for the Hurtigruten endpoints both scrapers call.
+
+Serves synthetic responses, shaped like the real ones, for
+
+    POST /api/Availability                                  (coastal)
+    GET  /api/travelfilter                                  (explorer tour list)
+    GET  /tour/<n>                                          (explorer tour pages)
+    POST /api//travelsuggestions/gateways
+    POST /api/availability/travelsuggestions/grouped
+    GET  /api/quotes/<quoteId>/packagePrices
+
+with a fixed latency added to every response. Prices depend only on the
+request, so two runs against the same stub store the same rows. Tour pages
+carry an ETag and answer a matching If-None-Match with 304 Not Modified.
+
+Usage: python benchmarks/stub_api.py [--port N] [--latency MS] [...]
+
+or from Python: server = serve(Fixtures(tours=5)); ...; server.shutdown()
+
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class Fixtures(object):
+    """Sizes and latency of the synthetic responses.
+
+    Args:
+        latency: seconds every response is delayed by.
+        days: calendar days per Availability response.
+        voyages: voyages per calendar day.
+        categories: category prices per voyage (coastal) or quote (explorer).
+        tours: tours in the travelfilter response.
+        codes: tour codes on every tour page.
+        dates: departure dates in every grouped response.
+        page_kb: filler added to every tour page, in kB.
+        empty: (fromPort, toPort) routes without sailings, their calendar
+            days have voyages None like the padding days of the real API.
+
+    """
+    def __init__(self, latency=0.0, days=30, voyages=1, categories=20, tours=10, codes=2, dates=12, page_kb=100, empty=()):
+        self.latency = latency
+        self.days = days
+        self.voyages = voyages
+        self.categories = categories
+        self.tours = tours
+        self.codes = codes
+        self.dates = dates
+        self.page_kb = page_kb
+        self.empty = set(empty)
+
+    def availability(self, payload):
+        start = datetime.strptime(payload['searchFromDateTime'][:10], '%Y-%m-%d')
+        seed = sum(map(ord, payload['fromPort'] + payload['toPort'] + payload['marketCode']))
+        calendar = []
+        for d in range(self.days):
+            day = start + timedelta(days=d)
+            if (payload['fromPort'], payload['toPort']) in self.empty:
+                calendar.append({'date': '{:%Y-%m-%d}'.format(day), 'voyages': None})
+                continue
+            calendar.append({'date': '{:%Y-%m-%d}'.format(day), 'voyages': [
+                {'ship': {'shipCode': 'MS{}'.format((d + v) % 7)}, 'voyageType': 'NORTHBOUND' if v % 2 else 'SOUTHBOUND',
+                 'categoryPrices': [{'code': 'C{:02d}'.format(c), 'available': (seed + d + c) % 9 != 0,
+                                     'price': {'amount': 1000 + (seed * 7 + d * 13 + c * 31) % 5000}}
+                                    for c in range(self.categories)]}
+                for v in range(self.voyages)]})
+        return {'calendar': calendar}
+
+    def travelfilter(self):
+        return {'voyages': [{'voyageUrl': '/tour/{}'.format(i), 'image': '/images/tour{}.jpg'.format(i), 'map': '/maps/tour{}.png'.format(i),
+                             'name': 'Tour {}'.format(i), 'destination': {'name': 'Destination {}'.format(i % 4)}, 'ships': [{'id': 'FRA'}]}
+                            for i in range(self.tours)]}
+
+    def tour_page(self, n):
+        products = ', '.join('{{id: "T{}C{}"}}'.format(n, c) for c in range(self.codes))
+        filler = '<p>{}</p>'.format('x' * 1000) * self.page_kb
+        return ('<html><head><title>Tour {0}</title></head><body>'
+                '<div class="top-image-promotion">Book now</div>{1}'
+                '<script>var tour = {{products: [{2}]}};</script></body></html>').format(n, filler, products)
+
+    def gateways(self, payload):
+        return {'gateways': [{'firstAvailableDate': '2021-05-01T00:00:00'}]}
+
+    def grouped(self, payload):
+        start = datetime(2021, 5, 1)
+        return {'quoteId': '{}-{}'.format(payload['packageCode'], payload['marketCode']),
+                'calendar': [{'date': '{:%Y-%m-%d}T00:00:00'.format(start + timedelta(days=14 * d)),
+                              'voyages': [{'voyageId': 'V{}'.format(d), 'ship': {'shipCode': 'FRA' if d % 2 else 'ROA'}}]}
+                             for d in range(self.dates)]}
+
+    def package_prices(self, quote_id, date):
+        seed = sum(map(ord, quote_id + date))
+        return {'categoryPrices': [{'code': 'P{:02d}'.format(c), 'price': {'amount': 20000 + (seed * 11 + c * 97) % 40000}}
+                                   for c in range(self.categories)]}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, with Nagle on every keep-alive response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def respond(self, method):
+        fixtures = self.server.fixtures
+        url = urlsplit(self.path)
+        length = int(self.headers.get('content-length') or 0)
+        payload = json.loads(self.rfile.read(length)) if length else None
+        if fixtures.latency:
+            time.sleep(fixtures.latency)
+        quote = re.match(r'/api/quotes/([^/]+)/packagePrices$', url.path)
+        tour = re.match(r'/tour/(\d+)$', url.path)
+        if method == 'POST' and url.path == '/api/Availability':
+            name, body = 'availability', fixtures.availability(payload)
+        elif method == 'GET' and url.path == '/api/travelfilter':
+            name, body = 'travelfilter', fixtures.travelfilter()
+        elif method == 'GET' and tour:
+            name, body = 'tour', fixtures.tour_page(int(tour.group(1)))
+        elif method == 'POST' and url.path == '/api//travelsuggestions/gateways':
+            name, body = 'gateways', fixtures.gateways(payload)
+        elif method == 'POST' and url.path == '/api/availability/travelsuggestions/grouped':
+            name, body = 'grouped', fixtures.grouped(payload)
+        elif method == 'GET' and quote:
+            name, body = 'packagePrices', fixtures.package_prices(quote.group(1), parse_qs(url.query)['date'][0])
+        else:
+            self.send_error(404)
+            return
+        self.server.count(name)
+        headers = {}
+        if isinstance(body, str):
+            data, content_type = body.encode('utf-8'), 'text/html; charset=utf-8'
+            headers['ETag'] = '"{}"'.format(hashlib.sha1(data).hexdigest())
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                self.send_response(304)
+                self.send_header('ETag', headers['ETag'])
+                self.send_header('content-length', '0')
+                self.end_headers()
+                return
+        else:
+            data, content_type = json.dumps(body).encode('utf-8'), 'application/json; charset=utf-8'
+        self.send_response(200)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StubServer(ThreadingHTTPServer):
+    """Threaded HTTP server that counts the requests served per endpoint"""
+    daemon_threads = True
+
+    def __init__(self, address, fixtures):
+        ThreadingHTTPServer.__init__(self, address, Handler)
+        self.fixtures = fixtures
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    @property
+    def base(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def handle_error(self, request, client_address):
+        # Scrapers dropping keep-alive connections when they exit are not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def served(self):
+        """Requests served so far, per endpoint"""
+        with self.lock:
+            return dict(self.requests)
+
+
+def serve(fixtures=None, host='127.0.0.1', port=0):
+    """Starts a stub server on a background thread, port 0 picks a free port"""
+    server = StubServer((host, port), fixtures or Fixtures())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def point(scraper, base):
+    """Points the endpoints of a scraper (either kind) at the stub at base"""
+    if hasattr(scraper, 'quote_url'):
+        scraper.main = base
+        scraper.travelfilter_url = base + '/api/travelfilter?destinationId=&departureMonthYear=&shipId=&marketCode=NO&languageCode=no'
+        scraper.gateways_url = base + '/api//travelsuggestions/gateways'
+        scraper.grouped_url = base + '/api/availability/travelsuggestions/grouped'
+        scraper.quote_url = base + '/api/quotes/{}/packagePrices?date={}&voyageId={}'
+    else:
+        scraper.url = base + '/api/Availability'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every response')
+    for name in ('days', 'voyages', 'categories', 'tours', 'codes', 'dates', 'page_kb'):
+        parser.add_argument('--' + name.replace('_', '-'), type=int, default=getattr(Fixtures(), name))
+    args = parser.parse_args()
+    fixtures = Fixtures(args.latency / 1000.0, args.days, args.voyages, args.categories, args.tours, args.codes, args.dates, args.page_kb)
+    server = StubServer(('127.0.0.1', args.port), fixtures)
+    print('serving on', server.base)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
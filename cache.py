@@ -0,0 +1,78 @@
+"""On-disk cache of raw API responses.
+
+Every response is stored gzipped under the sha256 of method, URL and
+payload, so a run can be replayed (re-parsed into Pricing.db) without
+sending a single request.
+
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import time
+
+
+class CacheMiss(Exception):
+    """Raised in offline mode when a request has no cached response"""
+
+
+class ResponseCache(object):
+    """Content-addressed response store with TTL eviction.
+
+    Args:
+        directory: where the entries are written, created on first use.
+        ttl: seconds an entry is kept before evict() removes it, None to keep forever.
+
+    """
+    def __init__(self, directory, ttl=30 * 24 * 3600):
+        self.directory = directory
+        self.ttl = ttl
+
+    def key(self, method, url, payload=None):
+        digest = hashlib.sha256()
+        for part in (method.upper(), url, payload or ''):
+            digest.update(part.encode('utf-8') if isinstance(part, str) else part)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json.gz')
+
+    def get(self, method, url, payload=None, max_age=None):
+        """Returns the cached entry as a dict, or None if missing or older than max_age seconds"""
+        path = self.path(self.key(method, url, payload))
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if max_age is not None and time.time() - entry['fetched'] > max_age:
+            return None
+        return entry
+
+    def put(self, method, url, payload, status, headers, body):
+        """Stores a response. body is the decoded response text"""
+        path = self.path(self.key(method, url, payload))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {'method': method.upper(), 'url': url, 'payload': payload, 'status': status,
+                 'headers': dict(headers), 'fetched': time.time(), 'body': body}
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            json.dump(entry, f)
+        # Atomic, so concurrent fetch threads never see half written entries
+        os.replace(tmp, path)
+
+    def evict(self):
+        """Removes entries older than the TTL, returns how many were removed"""
+        if self.ttl is None or not os.path.isdir(self.directory):
+            return 0
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+        return removed
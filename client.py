@@ -0,0 +1,146 @@
+"""Shared HTTP client for the scrapers.
+
+One requests.Session is kept per scraper so connections to the Hurtigruten
+hosts are pooled and reused (keep-alive) instead of doing a new TCP/TLS
+handshake per call.
+
+"""
+
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache import CacheMiss
+from metrics import DISABLED
+
+# Errors of a request itself, worth sending again later in the run; an
+# error raised while handling a response comes back every time it is sent
+TRANSIENT = (requests.RequestException, CacheMiss)
+
+
+class HttpClient(object):
+    """Pooled HTTP client with per-host rate limiting and retries.
+
+    Requests answered with 429 or a 5xx status, and requests that fail to
+    connect, are retried with exponential backoff (backoff * 2 ** retry
+    seconds, honouring Retry-After). Once the retries are used up the error
+    is raised to the caller.
+
+    Args:
+        rate: default maximum requests per second for any host, None for no limit.
+        rate_limits: dict of host -> requests per second, overrides rate.
+        retries: number of retries per request.
+        backoff: backoff factor in seconds.
+        pool_size: connections kept open per host.
+        timeout: seconds to wait for a response.
+        cache: optional cache.ResponseCache every successful response is written to.
+        fresh: serve cached responses younger than this many seconds instead of
+            sending the request, None to always send it.
+
+    In offline mode (self.offline = True) responses only come from the cache,
+    regardless of their age, and a missing entry raises cache.CacheMiss.
+
+    Request latencies and cache hits are recorded in self.metrics (see
+    metrics.py) under the endpoint name given to request(), the host by default.
+
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    TRANSFER_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+
+    def __init__(self, rate=None, rate_limits=None, retries=5, backoff=0.5, pool_size=10, timeout=60, cache=None, fresh=None):
+        self.cache = cache
+        self.fresh = fresh
+        self.offline = False
+        self.metrics = DISABLED
+        self.rate = rate
+        self.rate_limits = dict(rate_limits or {})
+        self.timeout = timeout
+        # POSTs are retried too: every call the scrapers make is a read
+        self.retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=self.RETRY_STATUS,
+                           allowed_methods=None, respect_retry_after_header=True)
+        self.pool_size = pool_size
+        self.reset()
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def reset(self):
+        """Starts a new session, used in forked processes so no connection is shared with the parent"""
+        self.session = requests.Session()
+        self.mount(self.pool_size)
+
+    def mount(self, pool_size):
+        """(Re)creates the connection pools, keeping pool_size connections per host"""
+        self.pool_size = pool_size
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=self.retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def throttle(self, url):
+        """Blocks until the host of url may be sent another request"""
+        host = urlsplit(url).netloc
+        rate = self.rate_limits.get(host, self.rate)
+        if not rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + 1.0 / rate
+        if slot > now:
+            self.metrics.observe('stage_seconds', slot - now, stage='throttle')
+            time.sleep(slot - now)
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        payload = kwargs.get('data')
+        endpoint = endpoint or urlsplit(url).netloc
+        if self.cache is not None and (self.offline or self.fresh is not None):
+            entry = self.cache.get(method, url, payload, None if self.offline else self.fresh)
+            if entry is not None:
+                self.metrics.inc('cache_hits_total', endpoint=endpoint)
+                return self.cached_response(entry)
+        if self.offline:
+            raise CacheMiss('{} {}'.format(method, url))
+        self.throttle(url)
+        kwargs.setdefault('timeout', self.timeout)
+        with self.metrics.time('request_seconds', endpoint=endpoint):
+            response = self.session.request(method, url, **kwargs)
+        response.raise_for_status()
+        # A 304 has no body, the cache keeps the full response it revalidated
+        if self.cache is not None and response.status_code != 304:
+            # The body is stored decoded, so the transfer headers no longer apply to it
+            headers = {k: v for k, v in response.headers.items() if k.lower() not in self.TRANSFER_HEADERS}
+            self.cache.put(method, url, payload, response.status_code, headers, response.text)
+        return response
+
+    def cached_response(self, entry):
+        """Rebuilds a requests.Response from a cache entry"""
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers.update(entry['headers'])
+        response.url = entry['url']
+        response.encoding = 'utf-8'
+        response._content = entry['body'].encode('utf-8')
+        return response
+
+    def get(self, url, endpoint=None, **kwargs):
+        return self.request('GET', url, endpoint, **kwargs)
+
+    def post(self, url, endpoint=None, **kwargs):
+        return self.request('POST', url, endpoint, **kwargs)
+
+    def __getstate__(self):
+        # Locks can't be pickled, worker processes get their own limiter state
+        state = self.__dict__.copy()
+        del state['lock']
+        state['next_slot'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
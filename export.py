@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""Columnar export of Pricing.db and vectorized price-trend analytics.
+
+Materializes the star schema (fact table joined to its dimension tables)
+into Parquet, partitioned by ReportDate (hive style,
+<out>/<table>/ReportDate=YYYY-MM-DD/part-0.parquet). A report date is
+skipped if its partition holds just the part-0.parquet of an export with
+as many rows as the table has for it, so a daily export only appends the
+new run. Any other partition is replaced: a report date exported while it
+was still being written (the scheduler writes today's all day, a run may
+be resumed or retried later), or one a sinks.ParquetSink wrote its part
+files to.
+
+Usage: python export.py --db Pricing.db --out parquet [--table Data ...]
+
+Requires pandas and pyarrow.
+
+"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from sinks import parquet_schema
+from storage import COMPACT
+
+# Denormalized columns of each exportable table; the *_Delta_Snapshot views
+# of the delta storage mode have the same shape as the table they rebuild
+QUERIES = {
+    'Data': '''
+        SELECT r.ReportDate, s.ShipCode, c.Category, v.VoyageType, d.DepartureDate,
+               dp.PortName AS DeparturePort, ap.PortName AS ArrivalPort, m.SourceMarket,
+               f.occupancy, f.viaKKN, f.price
+        FROM {table} f
+        JOIN dimReportDate r ON r.id = f.rDate_id
+        JOIN dimShips s ON s.id = f.ship_id
+        JOIN dimCabinCategory c ON c.id = f.cat_id
+        JOIN dimVoyage v ON v.id = f.type_id
+        JOIN dimDepartureDate d ON d.id = f.dep_id
+        JOIN dimDeparturePorts dp ON dp.id = f.dport_id
+        JOIN dimArrivalPorts ap ON ap.id = f.aport_id
+        JOIN dimSourceMarket m ON m.id = f.source_id
+        WHERE f.rDate_id = ?''',
+    'Data_Explorer': '''
+        SELECT r.ReportDate, s.ShipCode, c.Category, v.VoyageType, d.DepartureDate,
+               t.TourName, ds.Destination, m.SourceMarket, f.price, t.TourImg, t.TourMap
+        FROM {table} f
+        JOIN dimReportDate r ON r.id = f.rDate_id
+        JOIN dimShips s ON s.id = f.ship_id
+        JOIN dimCabinCategory c ON c.id = f.cat_id
+        JOIN dimVoyage v ON v.id = f.type_id
+        JOIN dimDepartureDate d ON d.id = f.dep_id
+        JOIN dimTour t ON t.id = f.tour_id
+        JOIN dimDestination ds ON ds.id = f.dest_id
+        JOIN dimSourceMarket m ON m.id = f.source_id
+        WHERE f.rDate_id = ?''',
+}
+QUERIES['Data_Delta_Snapshot'] = QUERIES['Data']
+QUERIES['Data_Explorer_Delta_Snapshot'] = QUERIES['Data_Explorer']
+
+# Columns identifying one price across report dates
+KEYS = {
+    'Data': ['ShipCode', 'Category', 'VoyageType', 'DepartureDate', 'DeparturePort', 'ArrivalPort', 'SourceMarket'],
+    'Data_Explorer': ['ShipCode', 'Category', 'VoyageType', 'DepartureDate', 'TourName', 'Destination', 'SourceMarket'],
+}
+KEYS['Data_Delta_Snapshot'] = KEYS['Data']
+KEYS['Data_Explorer_Delta_Snapshot'] = KEYS['Data_Explorer']
+
+# The compact storage format keeps prices in minor units
+COMPACT_COLUMNS = [('f.price', 'f.price / 100.0 AS price')]
+
+
+def exported(out, table):
+    """Rows export() wrote for every report date, read from the Parquet footer.
+
+    Partitions holding other files than the part-0.parquet of export() are
+    left out, like those of a sinks.ParquetSink.
+
+    """
+    root = os.path.join(out, table)
+    if not os.path.isdir(root):
+        return {}
+    rows = {}
+    for name in os.listdir(root):
+        partition = os.path.join(root, name)
+        if not name.startswith('ReportDate=') or not os.path.isdir(partition):
+            continue
+        if [part for part in os.listdir(partition) if part.endswith('.parquet')] == ['part-0.parquet']:
+            rows[name.split('=', 1)[1]] = pq.ParquetFile(os.path.join(partition, 'part-0.parquet')).metadata.num_rows
+    return rows
+
+
+def export(db, out, table='Data'):
+    """Writes every report date of table not exported completely yet, returns the dates written"""
+    connection = sqlite3.connect(db)
+    try:
+        if not connection.execute("SELECT 1 FROM sqlite_master WHERE name = ?;", (table, )).fetchone():
+            return []
+        done = exported(out, table)
+        query = QUERIES[table].format(table=table)
+        if connection.execute('PRAGMA user_version;').fetchone()[0] >= COMPACT:
+            for column, converted in COMPACT_COLUMNS:
+                query = query.replace(column, converted)
+        dates = connection.execute('''SELECT r.id, r.ReportDate, f.rows FROM dimReportDate r
+                                      JOIN (SELECT rDate_id, count(*) AS rows FROM {} GROUP BY rDate_id) f ON f.rDate_id = r.id
+                                      ORDER BY r.ReportDate;'''.format(table)).fetchall()
+        written = []
+        for rdate_id, report_date, rows in dates:
+            if done.get(report_date) == rows:
+                continue
+            frame = pd.read_sql_query(query, connection, params=(rdate_id, ))
+            partition = os.path.join(out, table, 'ReportDate=' + report_date)
+            # Written next to the partition and renamed, so an interrupted export leaves no partial partition
+            tmp, old = partition + '.tmp', partition + '.old'
+            shutil.rmtree(tmp, ignore_errors=True)
+            shutil.rmtree(old, ignore_errors=True)
+            os.makedirs(tmp)
+            frame = frame.drop(columns='ReportDate')
+            # The types of sinks.ParquetSink, whatever the storage format: occupancy and viaKKN are REAL in the original one
+            frame.to_parquet(os.path.join(tmp, 'part-0.parquet'), index=False, schema=parquet_schema(frame.columns))
+            if os.path.isdir(partition):
+                os.rename(partition, old)
+            os.rename(tmp, partition)
+            shutil.rmtree(old, ignore_errors=True)
+            written.append(report_date)
+        return written
+    finally:
+        connection.close()
+
+
+def load(out, table='Data', columns=None, filters=None):
+    """Reads an exported table back as a DataFrame, ReportDate as a string column.
+
+    columns and filters are passed on to pandas.read_parquet, e.g.
+    filters=[('SourceMarket', '=', 'DE')].
+
+    """
+    frame = pd.read_parquet(os.path.join(out, table), columns=columns, filters=filters)
+    frame['ReportDate'] = frame['ReportDate'].astype(str)
+    return frame
+
+
+def price_changes(frame, table='Data'):
+    """Adds the change in price of every row since the previous report date it was seen on.
+
+    Adds the columns previous and change; rows seen for the first time get NaN.
+
+    """
+    keys = KEYS[table]
+    frame = frame.sort_values(keys + ['ReportDate'], kind='mergesort')
+    previous = frame.groupby(keys, sort=False, observed=True)['price'].shift()
+    return frame.assign(previous=previous, change=frame['price'] - previous)
+
+
+def price_change(frame, from_date, to_date, table='Data'):
+    """Price per departure on two report dates side by side, with the absolute and relative change.
+
+    Only keys present on both dates are returned.
+
+    """
+    keys = KEYS[table]
+    before = frame.loc[frame['ReportDate'] == from_date, keys + ['price']]
+    after = frame.loc[frame['ReportDate'] == to_date, keys + ['price']]
+    merged = before.merge(after, on=keys, suffixes=('_from', '_to'))
+    merged['change'] = merged['price_to'] - merged['price_from']
+    merged['pct'] = merged['change'] / merged['price_from'] * 100
+    return merged
+
+
+def category_range(frame, by=('ReportDate', 'Category')):
+    """Minimum, maximum and mean price per cabin category (and report date)"""
+    return frame.groupby(list(by), observed=True)['price'].agg(['min', 'max', 'mean', 'count']).reset_index()
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Exports Pricing.db to Parquet partitioned by ReportDate')
+    PARSER.add_argument('--db', required=True, help='path of Pricing.db')
+    PARSER.add_argument('--out', required=True, help='directory the tables are exported to')
+    PARSER.add_argument('--table', action='append', choices=sorted(QUERIES), help='table to export, repeatable (default: Data and Data_Explorer)')
+    ARGS = PARSER.parse_args()
+    for TABLE in ARGS.table or ['Data', 'Data_Explorer']:
+        print(TABLE, 'exported report dates:', ', '.join(export(ARGS.db, ARGS.out, TABLE)) or 'none')
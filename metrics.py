@@ -0,0 +1,240 @@
+"""Run metrics of the scrapers: per-stage timings, request latencies and counters.
+
+A scraper starts with DISABLED, whose methods do nothing, so the calls left
+in the hot paths cost one no-op method call each. Assign a Metrics to
+scraper.metrics to record a run, then write() it out as a JSON summary and
+a Prometheus text-format file (e.g. for node_exporter's textfile collector).
+
+Recorded by the scrapers:
+    request_seconds{endpoint}           HTTP latency, cache hits excluded
+    cache_hits_total{endpoint}          responses served from the response cache
+    stage_seconds{stage}                fetch, decode, html_parse, parse, store, commit, ...
+    rows_total{table, result}           fact rows written, ignored (duplicate key) or unchanged (delta mode)
+    failures_total{stage, reason}       failed work by exception type
+    tour_pages_total{result}            Explorer tour pages fetched, not modified or reused
+    refreshes_total{result}             scheduler work items refreshed, failed or dropped (scheduler.py)
+    requests_saved_total{reason}        coastal Availability requests saved against the monthly grid (planner.py)
+
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Upper bounds in seconds, Prometheus adds +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HELP = {
+    'request_seconds': ('histogram', 'HTTP request latency per endpoint'),
+    'stage_seconds': ('histogram', 'Time spent per scraper stage'),
+    'cache_hits_total': ('counter', 'Responses served from the response cache'),
+    'rows_total': ('counter', 'Fact rows by result: written, ignored as duplicates or unchanged'),
+    'failures_total': ('counter', 'Failed work by stage and reason'),
+    'tour_pages_total': ('counter', 'Explorer tour pages by result: fetched, not_modified (304) or reused within the run'),
+    'refreshes_total': ('counter', 'Scheduled work items by result: done, failed or dropped'),
+    'requests_saved_total': ('counter', 'Availability requests saved against the monthly grid, by window planning or skipped empty routes'),
+    'run_seconds': ('gauge', 'Wall time of the run'),
+}
+
+
+class _Timer(object):
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullMetrics(object):
+    """Metrics that records nothing"""
+    enabled = False
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def time(self, name, **labels):
+        return _NULL_TIMER
+
+    def failure(self, stage, error):
+        pass
+
+    def merge(self, other):
+        pass
+
+    def spawn(self):
+        return self
+
+
+DISABLED = NullMetrics()
+
+
+class Metrics(object):
+    """Counters and latency histograms of one run.
+
+    Thread safe, and picklable so worker processes can send theirs back to
+    be merged.
+
+    Args:
+        scraper: value of the scraper label on every exported sample.
+
+    """
+    enabled = True
+
+    def __init__(self, scraper):
+        self.scraper = scraper
+        self.started = time.time()
+        self.counters = {}
+        # (name, labels) -> [count per bucket..., count, sum, max]
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(BUCKETS) + [0, 0.0, 0.0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-3] += 1
+            histogram[-2] += seconds
+            histogram[-1] = max(histogram[-1], seconds)
+
+    def time(self, name, **labels):
+        """Context manager observing the time spent in its block"""
+        return _Timer(self, name, labels)
+
+    def failure(self, stage, error):
+        self.inc('failures_total', stage=stage, reason=type(error).__name__)
+
+    def spawn(self):
+        """An empty Metrics with the same labels, e.g. for a worker process"""
+        return Metrics(self.scraper)
+
+    def merge(self, other):
+        """Adds the counts of another Metrics, e.g. of a worker process"""
+        with self.lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, theirs in other.histograms.items():
+                ours = self.histograms.setdefault(key, [0] * len(BUCKETS) + [0, 0.0, 0.0])
+                for i in range(len(ours) - 1):
+                    ours[i] += theirs[i]
+                ours[-1] = max(ours[-1], theirs[-1])
+
+    def summary(self):
+        """The run as a JSON serializable dict"""
+        with self.lock:
+            counters, histograms = dict(self.counters), dict((k, list(v)) for k, v in self.histograms.items())
+        summary = OrderedDict([('scraper', self.scraper), ('started', self.started),
+                               ('run_seconds', time.time() - self.started), ('counters', []), ('histograms', [])])
+        for (name, labels), value in sorted(counters.items()):
+            summary['counters'].append(OrderedDict([('name', name), ('labels', dict(labels)), ('value', value)]))
+        for (name, labels), histogram in sorted(histograms.items()):
+            count, total, peak = histogram[-3:]
+            summary['histograms'].append(OrderedDict([
+                ('name', name), ('labels', dict(labels)), ('count', count), ('sum', total),
+                ('mean', total / count if count else None), ('max', peak),
+                ('p50', self.quantile(histogram, 0.5)), ('p95', self.quantile(histogram, 0.95)),
+                ('buckets', OrderedDict((str(bound), n) for bound, n in zip(BUCKETS, histogram)))]))
+        return summary
+
+    @staticmethod
+    def quantile(histogram, q):
+        """Upper bucket bound below which a fraction q of the observations fall"""
+        count = histogram[-3]
+        if not count:
+            return None
+        seen = 0
+        for bound, n in zip(BUCKETS, histogram):
+            seen += n
+            if seen >= q * count:
+                return bound
+        return histogram[-1]
+
+    def prometheus(self):
+        """The run in the Prometheus text exposition format"""
+        def labels(pairs):
+            pairs = (('scraper', self.scraper), ) + pairs
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+        with self.lock:
+            counters, histograms = dict(self.counters), dict((k, list(v)) for k, v in self.histograms.items())
+        samples = {'run_seconds': ['hrg_run_seconds{} {}'.format(labels(()), time.time() - self.started)]}
+        for (name, pairs), value in sorted(counters.items()):
+            samples.setdefault(name, []).append('hrg_{}{} {}'.format(name, labels(pairs), value))
+        for (name, pairs), histogram in sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(BUCKETS, histogram):
+                cumulative += n
+                lines.append('hrg_{}_bucket{} {}'.format(name, labels(pairs + (('le', bound), )), cumulative))
+            lines.append('hrg_{}_bucket{} {}'.format(name, labels(pairs + (('le', '+Inf'), )), histogram[-3]))
+            lines.append('hrg_{}_sum{} {}'.format(name, labels(pairs), histogram[-2]))
+            lines.append('hrg_{}_count{} {}'.format(name, labels(pairs), histogram[-3]))
+        out = []
+        for name in sorted(samples):
+            kind, text = HELP.get(name, ('untyped', name))
+            out.append('# HELP hrg_{} {}'.format(name, text))
+            out.append('# TYPE hrg_{} {}'.format(name, kind))
+            out.extend(samples[name])
+        return '\n'.join(out) + '\n'
+
+    def write(self, directory):
+        """Writes <scraper>.json and <scraper>.prom to directory, returns their paths"""
+        base = os.path.join(directory, self.scraper)
+        with open(base + '.json', 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        # Written under a temporary name first, the textfile collector must never read a partial file
+        with open(base + '.prom.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.replace(base + '.prom.tmp', base + '.prom')
+        return base + '.json', base + '.prom'
+
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""Converts a Pricing.db to the compact storage format (see storage.py).
+
+The target database is created through the scrapers' own sql3_storage(),
+then filled from the attached source with INSERT ... SELECT, one report
+date per transaction, so memory stays bounded by SQLite's page cache
+whatever the size of the database. Report dates already in the target are
+skipped, an interrupted migration is continued by running it again. The
+latest-price tables are rebuilt from the migrated facts and the file is
+vacuumed at the end.
+
+Dates become day numbers, prices integer minor units. Checkpoints are not
+migrated: a run resumed on the new database starts its report date over.
+
+Usage: python migrate.py Pricing.db Pricing.compact.db [--compare]
+
+With --compare the file sizes and the time of a full scan and of a scan
+of the last report date of every fact table are printed for both
+databases.
+
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+from Explorer_pricescraper import HurtigrutenAPI
+from PricingV2 import HRGCoastalPScraper
+from storage import DAY_DIMENSIONS, DAY_SQL, DeltaWriter, TourPages, is_compact, tune
+
+# Fact columns holding a date id and how the other value columns are converted
+DAYS = {'rDate_id': 'report_days', 'dep_id': 'departure_days'}
+VALUES = {'occupancy': 'CAST(f.occupancy AS integer)', 'viaKKN': 'CAST(f.viaKKN AS integer)',
+          'price': 'CAST(round(f.price * 100) AS integer)'}
+
+
+def tables(connection, schema='main'):
+    return set(row[0] for row in connection.execute("SELECT name FROM {}.sqlite_master WHERE type IN ('table', 'view');".format(schema)))
+
+
+def open_target(scraper, target):
+    """Creates (or opens) the target through the scraper's sql3_storage() in the compact format"""
+    scraper.compact = True
+    scraper.sql3_storage(os.path.dirname(os.path.abspath(target)) + os.sep, os.path.basename(target))
+    return scraper
+
+
+def select(columns, table):
+    """SELECT converting the rows of table in the source, joined to the day number maps"""
+    converted, joins = [], []
+    for column in columns:
+        if column in DAYS:
+            converted.append('{}.new'.format(DAYS[column]))
+            joins.append('JOIN temp.{0} {0} ON {0}.old = f.{1}'.format(DAYS[column], column))
+        else:
+            converted.append(VALUES.get(column, 'f.' + column))
+    return 'SELECT {} FROM old.{} f {}'.format(', '.join(converted), table, ' '.join(joins))
+
+
+def migrate_dimensions(connection, dimensions):
+    for table, column in dimensions.items():
+        if table in DAY_DIMENSIONS:
+            connection.execute('INSERT OR IGNORE INTO main.{0}(id, {1}) SELECT {2}, {1} FROM old.{0};'.format(table, column, DAY_SQL.format(column)))
+            continue
+        columns = ', '.join(row[1] for row in connection.execute('PRAGMA main.table_info({});'.format(table)))
+        connection.execute('INSERT OR IGNORE INTO main.{0}({1}) SELECT {1} FROM old.{0};'.format(table, columns))
+    connection.commit()
+
+
+def migrate_facts(connection, table, columns):
+    """Copies table one report date at a time, returns the rows copied"""
+    sql = 'INSERT OR IGNORE INTO main.{}({}) {} WHERE f.rDate_id = ?;'.format(table, ', '.join(columns), select(columns, table))
+    copied = 0
+    for old, new, report_date in connection.execute('''SELECT m.old, m.new, r.ReportDate FROM temp.report_days m
+                                                       JOIN old.dimReportDate r ON r.id = m.old ORDER BY m.new;''').fetchall():
+        if connection.execute('SELECT 1 FROM main.{} WHERE rDate_id = ? LIMIT 1;'.format(table), (new, )).fetchone():
+            continue
+        rows = connection.execute(sql, (old, )).rowcount
+        connection.commit()
+        if rows:
+            copied += rows
+            print('{} {} {} rows'.format(table, report_date, rows))
+    return copied
+
+
+def migrate_delta(connection, table, columns, keys):
+    """Copies the delta table of table and the report dates it was written for"""
+    DeltaWriter(connection, table, columns, keys, compact=True)
+    delta = table + '_Delta'
+    key_columns, value_columns = columns[1:keys + 1], columns[keys + 1:]
+    if connection.execute('SELECT 1 FROM main.{} LIMIT 1;'.format(delta)).fetchone():
+        return
+    converted = [('departure_days.new' if c == 'dep_id' else 'f.' + c) for c in key_columns] + [VALUES.get(c, 'f.' + c) for c in value_columns]
+    connection.execute('''INSERT INTO main.{0}({1}, validFrom_id, validTo_id, lastSeen_id)
+                          SELECT {2}, valid_from.new, valid_to.new, last_seen.new FROM old.{0} f
+                          JOIN temp.departure_days departure_days ON departure_days.old = f.dep_id
+                          JOIN temp.report_days valid_from ON valid_from.old = f.validFrom_id
+                          LEFT JOIN temp.report_days valid_to ON valid_to.old = f.validTo_id
+                          JOIN temp.report_days last_seen ON last_seen.old = f.lastSeen_id;'''.format(
+        delta, ', '.join(key_columns + value_columns), ', '.join(converted)))
+    connection.execute('''INSERT OR IGNORE INTO main.DeltaReportDates(TableName, rDate_id)
+                          SELECT d.TableName, m.new FROM old.DeltaReportDates d JOIN temp.report_days m ON m.old = d.rDate_id
+                          WHERE d.TableName = ?;''', (delta, ))
+    connection.commit()
+    print('{} {} rows'.format(delta, connection.execute('SELECT count(*) FROM main.{};'.format(delta)).fetchone()[0]))
+
+
+def migrate(source, target):
+    check = sqlite3.connect(source)
+    compact = is_compact(check)
+    check.close()
+    if compact:
+        raise SystemExit('{} is already in the compact format'.format(source))
+    if os.path.exists(target):
+        check = sqlite3.connect(target)
+        compact = is_compact(check, True)
+        check.close()
+        if not compact:
+            raise SystemExit('{} exists and is not in the compact format'.format(target))
+    scrapers = [HRGCoastalPScraper(), HurtigrutenAPI()]
+    for scraper in scrapers:
+        open_target(scraper, target).connection.close()
+
+    connection = sqlite3.connect(target)
+    tune(connection, wal=False)
+    connection.execute('ATTACH DATABASE ? AS old;', (source, ))
+    present = tables(connection, 'old')
+    connection.executescript('''
+    CREATE TEMP TABLE report_days (old integer PRIMARY KEY, new integer NOT NULL);
+    CREATE TEMP TABLE departure_days (old integer PRIMARY KEY, new integer NOT NULL);
+    ''')
+    for name, table, column in (('report_days', 'dimReportDate', 'ReportDate'), ('departure_days', 'dimDepartureDate', 'DepartureDate')):
+        if table in present:
+            connection.execute('INSERT INTO temp.{} SELECT id, {} FROM old.{};'.format(name, DAY_SQL.format(column), table))
+    for scraper in scrapers:
+        table = 'Data' if isinstance(scraper, HRGCoastalPScraper) else 'Data_Explorer'
+        if table not in present:
+            continue
+        migrate_dimensions(connection, dict((t, c) for t, c in scraper.DIMENSIONS.items() if t in present))
+        print('{}: {} rows copied'.format(table, migrate_facts(connection, table, scraper.FACT_COLUMNS)))
+        if table + '_Delta' in present:
+            migrate_delta(connection, table, scraper.FACT_COLUMNS, 7)
+    if 'TourPage' in present:
+        TourPages(connection)
+        connection.execute('INSERT OR IGNORE INTO main.TourPage SELECT * FROM old.TourPage;')
+        connection.commit()
+    connection.execute('DETACH DATABASE old;')
+    # Emptied so sql3_storage() fills them again from all the migrated facts
+    connection.executescript('DELETE FROM Data_Latest; DELETE FROM Data_Explorer_Latest;')
+    connection.close()
+    for scraper in scrapers:
+        open_target(scraper, target).connection.close()
+    # Pages filled by the inserts are left partly empty, rebuilding them takes temporary disk space, not memory
+    connection = sqlite3.connect(target)
+    connection.execute('VACUUM;')
+    connection.close()
+
+
+# Scans timed by compare(): name, query returning the rows scanned
+SCANS = [('full scan', 'SELECT count(*), sum(price) FROM {0};'),
+         ('last report date', 'SELECT count(*), sum(price) FROM {0} WHERE rDate_id = (SELECT max(rDate_id) FROM {0});')]
+
+
+def compare(source, target, repeat=3):
+    """Prints the size of both databases and the best time of the SCANS of every fact table"""
+    print('{:<36} {:>14} {:>14}'.format('', os.path.basename(source), os.path.basename(target)))
+    print('{:<36} {:>11.1f} MB {:>11.1f} MB'.format('file size', os.path.getsize(source) / 1048576.0, os.path.getsize(target) / 1048576.0))
+    connections = [sqlite3.connect(source), sqlite3.connect(target)]
+    for table in ('Data', 'Data_Explorer'):
+        if any(table not in tables(connection) for connection in connections):
+            continue
+        for name, sql in SCANS:
+            results = []
+            for connection in connections:
+                best = None
+                for _ in range(repeat):
+                    t = time.perf_counter()
+                    rows = connection.execute(sql.format(table)).fetchone()[0]
+                    best = min(best or float('inf'), time.perf_counter() - t)
+                results.append((best, rows))
+            print('{:<36} {:>12.4f} s {:>12.4f} s'.format('{}, {}'.format(table, name), results[0][0], results[1][0]))
+            print('{:<36} {:>14.0f} {:>14.0f}'.format('  rows/s', *(rows / best if best else 0 for best, rows in results)))
+    for connection in connections:
+        connection.close()
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Converts Pricing.db to the compact storage format')
+    PARSER.add_argument('source', help='database to convert, left unchanged')
+    PARSER.add_argument('target', help='compact database to create or continue')
+    PARSER.add_argument('--compare', action='store_true', help='print the size and scan speed of both databases')
+    ARGS = PARSER.parse_args()
+    migrate(ARGS.source, ARGS.target)
+    if ARGS.compare:
+        compare(ARGS.source, ARGS.target)
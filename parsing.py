@@ -0,0 +1,108 @@
+"""Price extraction for both scrapers, separate from storage.
+
+The functions here turn decoded (or still encoded) API responses into a
+stream of compact price records; whatever consumes the stream (the star
+schema writer, a worker queue, a benchmark) is up to the caller. None of
+them touch the database or the scraper objects, so they can be run and
+timed on their own against fixture files.
+
+If ijson is installed, calendar() can parse a response body incrementally
+so the calendar array is never decoded into one large list of dicts.
+
+tour_codes() and sold_out() read the Explorer tour pages with regular
+expressions instead of building a DOM; they cover the page layout the
+scraper's XPath expressions expect.
+
+"""
+
+import json
+import re
+from collections import namedtuple
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Rows of dimension values in DIMENSIONS order followed by the fact values.
+# namedtuples are tuples without a per-instance __dict__
+CoastalPrice = namedtuple('CoastalPrice', ['ReportDate', 'ShipCode', 'Category', 'VoyageType', 'DepartureDate',
+                                           'DeparturePort', 'ArrivalPort', 'SourceMarket', 'occupancy', 'viaKKN', 'price'])
+ExplorerPrice = namedtuple('ExplorerPrice', ['ReportDate', 'ShipCode', 'Category', 'VoyageType', 'DepartureDate',
+                                             'TourName', 'Destination', 'SourceMarket', 'price', 'TourImg', 'TourMap'])
+
+# Tour page patterns of tour_codes() and sold_out()
+SCRIPT = re.compile(r'<script\b[^>]*>(.*?)</script\s*>', re.S | re.I)
+PRODUCT_ID = re.compile(r'id: \"([^\"]+)\"')
+PROMOTION = re.compile(r"""<div\b[^>]*\bclass\s*=\s*["']top-image-promotion["'][^>]*>(.*?)</div\s*>""", re.S | re.I)
+ELEMENT = re.compile(r'<(\w+)\b[^>]*>.*?</\1\s*>', re.S)
+
+
+def calendar(source):
+    """Iterates the 'calendar' entries of an Availability or grouped response.
+
+    source is either the decoded response (dict), or its body as a binary
+    file object or bytes, which is parsed incrementally when ijson is
+    available and decoded at once otherwise.
+
+    """
+    if isinstance(source, dict):
+        return iter(source['calendar'] or ())
+    if isinstance(source, (bytes, str)):
+        source = source.encode('utf-8') if isinstance(source, str) else source
+        if ijson is None:
+            return iter(json.loads(source)['calendar'] or ())
+        return ijson.items(source, 'calendar.item', use_float=True)
+    if ijson is None:
+        return iter(json.load(source)['calendar'] or ())
+    return ijson.items(source, 'calendar.item', use_float=True)
+
+
+def coastal_rows(days, report_date, fromPort, toPort, market, occupancy, viaKKN):
+    """Yields a CoastalPrice for every available category price in the calendar days"""
+    for date in days:
+        if date['voyages'] == None:
+            continue
+        for sail in date['voyages']:
+            if sail['categoryPrices'] == None:
+                continue
+            for categ in sail['categoryPrices']:
+                if categ['available'] == True:
+                    yield CoastalPrice(report_date, sail['ship']['shipCode'], categ['code'], sail['voyageType'], date['date'],
+                                       fromPort, toPort, market, occupancy, viaKKN, categ['price']['amount'])
+
+
+def explorer_rows(quote, report_date, ship, voyage_type, voyage_date, tour, destination, market, img_url, map_url):
+    """Yields an ExplorerPrice for every category price of a packagePrices quote.
+
+    Prices that can't be parsed are skipped, as the scraper has always done.
+
+    """
+    for price in quote['categoryPrices']:
+        try:
+            yield ExplorerPrice(report_date, ship, price['code'], voyage_type, voyage_date,
+                                tour, destination, market, price['price']['amount'], img_url, map_url)
+        except Exception:
+            continue
+
+
+def tour_codes(html):
+    """Product codes of a tour page: the id: "..." values of the first script mentioning products.
+
+    Returns None if the page has no such script, so the caller can fall back
+    to a full parse.
+
+    """
+    for script in SCRIPT.finditer(html):
+        if 'products' in script.group(1):
+            return PRODUCT_ID.findall(script.group(1))
+    return None
+
+
+def sold_out(html):
+    """Whether the promotion text of a tour page says sold out"""
+    for div in PROMOTION.finditer(html):
+        # Only the div's own text counts, as with .../text() in XPath
+        if 'sold out' in ELEMENT.sub('', div.group(1)).lower():
+            return True
+    return False
@@ -0,0 +1,181 @@
+"""Availability request planning for serial runs of the coastal scraper.
+
+The grid of HRGCoastalPScraper.cells() sends one Availability request per
+month from the report month up to endDate, in every market and on every
+route. The calendar of a response often runs past the end of the month it
+was asked for, and some routes have no sailings at all in some markets.
+
+WindowPlanner walks one lane (departure port, arrival port, market) at a
+time instead. Each request starts the day after the last date the
+previous response covered, or at the first of the next month if that is
+later, and the last one at the grid's last month start, so a lane never
+takes more requests than the grid and no date the grid covers is left out.
+A lane whose last complete walk found no departures (calendars that only
+hold days without voyages, as the API pads them) is skipped until that
+walk is recheck days old.
+
+The dates every response covered (FirstDate to LastDate, and the number
+of Dates with voyages) are recorded in the Coverage table, and every
+completed lane in CoverageLanes. Both are written on the scraper's
+connection without a commit, so they are committed with the fact rows by
+the next flush. A resumed run continues each lane at its first window not
+recorded on the report date.
+
+Planning is opt-in (HRGCoastalPScraper.plan, --plan). A planned run covers
+the departure dates of the grid, but its responses start on other days, so
+where calendars overlap the first price stored for a date can come from
+another response than in a run of the grid. The concurrent and sharded
+modes always walk the grid and store the same database as a serial run of
+it.
+
+Recorded in the scraper's metrics:
+    requests_saved_total{reason}     Availability requests saved against the grid,
+                                     by window planning or skipped empty lanes
+
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from metrics import DISABLED
+
+
+def next_month(date):
+    """First of the month after date"""
+    return datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+
+def months(start, end):
+    """Month starts the grid searches from, from the month of start until end"""
+    date = datetime(start.year, start.month, 1)
+    while date < end:
+        yield date
+        date = next_month(date)
+
+
+def following(start, last, final):
+    """Start of the window after the one searching from start whose response covered dates up to last.
+
+    Never later than final, the last month start of the grid, before a
+    window has started there: its response may run past the end of the grid.
+
+    """
+    window = next_month(start)
+    if last is not None:
+        window = max(window, datetime.strptime(last, '%Y-%m-%d') + timedelta(days=1))
+    if start < final:
+        window = min(window, final)
+    return window
+
+
+def dates_of(days, dates):
+    """Passes calendar days through, appending (date, whether it has voyages) of each to dates"""
+    for day in days:
+        dates.append((day['date'][:10], bool(day['voyages'])))
+        yield day
+
+
+class WindowPlanner(object):
+    """Plans the Availability windows of one run.
+
+    Args:
+        connection: sqlite3 connection of the run.
+        report_date: report date of the run, 'YYYY-MM-DD'.
+        end: datetime the lanes are walked until (the scraper's endDate).
+        resume: skip lanes completed earlier on the report date and continue
+            the others at their first window not recorded.
+        recheck: days a lane found empty is skipped for.
+        metrics: metrics.Metrics the requests saved are recorded in.
+
+    """
+    def __init__(self, connection, report_date, end, resume=True, recheck=7, metrics=DISABLED):
+        self.connection = connection
+        self.report_date = report_date
+        self.end = end
+        self.resume = resume
+        self.metrics = metrics
+        self.connection.executescript('''
+    CREATE TABLE IF NOT EXISTS Coverage (ReportDate TEXT NOT NULL, FromPort TEXT NOT NULL, ToPort TEXT NOT NULL,
+                                         SourceMarket TEXT NOT NULL, SearchFrom TEXT NOT NULL,
+                                         FirstDate TEXT, LastDate TEXT, Dates integer NOT NULL,
+                                         PRIMARY KEY (ReportDate, FromPort, ToPort, SourceMarket, SearchFrom)) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS CoverageLanes (FromPort TEXT NOT NULL, ToPort TEXT NOT NULL, SourceMarket TEXT NOT NULL,
+                                              ReportDate TEXT NOT NULL, Requests integer NOT NULL, Dates integer NOT NULL,
+                                              PRIMARY KEY (FromPort, ToPort, SourceMarket, ReportDate)) WITHOUT ROWID;
+    ''')
+        since = '{:%Y-%m-%d}'.format(datetime.strptime(report_date, '%Y-%m-%d') - timedelta(days=recheck))
+        # The last completed walk of every lane: lane -> (report date, dates)
+        cr = self.connection.execute('''
+    SELECT FromPort, ToPort, SourceMarket, max(ReportDate), Dates FROM CoverageLanes
+    WHERE ReportDate <= ? GROUP BY FromPort, ToPort, SourceMarket;''', (report_date, ))
+        self.walked = dict((row[:3], row[3:]) for row in cr)
+        self.empty = set(lane for lane, (walked, dates) in self.walked.items() if not dates and walked > since)
+        self.done = set(lane for lane, (walked, dates) in self.walked.items() if walked == report_date and resume)
+        self.report = OrderedDict([('lanes', 0), ('empty_lanes', 0), ('grid', 0), ('requests', 0), ('saved_window', 0), ('saved_empty', 0)])
+
+    def windows(self, lane, start):
+        """Yields the datetimes the requests of lane search from, beginning in the month of start.
+
+        Tell record() the dates of each response before taking the next
+        window; a window without a record (a failed request) is followed by
+        the first of the next month and leaves the lane incomplete.
+
+        """
+        if lane in self.done:
+            return
+        grid = list(months(start, self.end))
+        if not grid:
+            return
+        start, final = grid[0], grid[-1]
+        where = 'WHERE ReportDate = ? AND FromPort = ? AND ToPort = ? AND SourceMarket = ?'
+        found, complete = 0, True
+        if self.resume:
+            recorded = self.connection.execute('SELECT SearchFrom, LastDate, Dates FROM Coverage {} ORDER BY SearchFrom;'.format(where),
+                                               (self.report_date, ) + lane).fetchall()
+            # Continued at the first window missing, e.g. one that failed before the run was interrupted
+            for search_from, last, dates in recorded:
+                if search_from != '{:%Y-%m-%d}'.format(start):
+                    break
+                start = following(start, last, final)
+                found += dates
+        else:
+            self.connection.execute('DELETE FROM Coverage {};'.format(where), (self.report_date, ) + lane)
+        # Grid requests left for this run
+        grid = sum(1 for month in grid if month >= datetime(start.year, start.month, 1))
+        self.report['lanes'] += 1
+        self.report['grid'] += grid
+        if lane in self.empty:
+            self.report['empty_lanes'] += 1
+            self.saved(grid, 'empty')
+            return
+        requests = 0
+        while start < self.end:
+            self.last = self.covered = None
+            requests += 1
+            yield start
+            if self.covered is None:
+                complete = False
+            found += self.covered or 0
+            start = following(start, self.last, final)
+        self.report['requests'] += requests
+        self.saved(grid - requests, 'window')
+        if complete:
+            self.connection.execute('INSERT OR REPLACE INTO CoverageLanes VALUES (?, ?, ?, ?, ?, ?);', lane + (self.report_date, requests, found))
+
+    def record(self, lane, start, dates):
+        """Records the dates covered by the response of lane to the window searching from start.
+
+        dates are the (date, has voyages) pairs collected by dates_of(). The
+        window advances past the last date of the calendar, days without
+        voyages included, but only days with voyages count as departures.
+
+        """
+        span = sorted(set(date for date, _ in dates))
+        self.last = span[-1] if span else None
+        self.covered = len(set(date for date, voyages in dates if voyages))
+        self.connection.execute('INSERT OR REPLACE INTO Coverage VALUES (?, ?, ?, ?, ?, ?, ?, ?);',
+                                (self.report_date, ) + lane + ('{:%Y-%m-%d}'.format(start), span[0] if span else None, self.last, self.covered))
+
+    def saved(self, requests, reason):
+        self.report['saved_' + reason] += requests
+        self.metrics.inc('requests_saved_total', requests, reason=reason)
@@ -0,0 +1,265 @@
+"""Long-running scheduler mode: refreshes each part of the price grid as often as its prices move.
+
+Instead of re-fetching everything up to endDate on every run, the scheduler
+keeps a priority queue (heapq, ordered by due time) of work items
+
+    coastal:  ((departure port, arrival port), market, 'YYYY-MM')
+    explorer: (tour name, market, 'YYYY-MM'), or month None for all dates of the tour
+
+and refreshes an item when it comes due. Its next refresh is then set by a
+Policy from how close its departures are and how volatile its prices have
+been: the share of consecutive report dates on which a price of the item
+changed, measured from the stored history over the last lookback days.
+
+Fact rows are keyed by report date and only the first price of a key per
+report date is kept, so refreshing an item more than once a day gains
+nothing and the shortest interval is a day. In delta mode keys that are
+no longer returned are not closed, since no single run covers the whole grid.
+
+The clock is injectable: FakeClock advances on sleep() instead of waiting,
+so days of scheduling can be simulated in seconds.
+
+Usage: python scheduler.py [--scraper coastal|explorer] [--months N] [--lookback DAYS] [--metrics DIR]
+
+"""
+
+import heapq
+import itertools
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from metrics import Metrics
+
+#A unit of scheduled work, scraper is the key of the scraper in Scheduler.scrapers
+Item = namedtuple('Item', ['scraper', 'target', 'market', 'month'])
+
+
+class Clock(object):
+    """Wall clock"""
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class FakeClock(object):
+    """Stand-in clock whose sleep() moves now() forward without waiting.
+
+    Args:
+        start: datetime the clock starts at.
+
+    """
+    def __init__(self, start):
+        self.current = start
+
+    def now(self):
+        return self.current
+
+    def sleep(self, seconds):
+        self.current += timedelta(seconds=seconds)
+
+
+class Policy(object):
+    """Refresh interval of a work item.
+
+    The base interval comes from how many days ahead the item's departure
+    month starts: the first step whose limit it is within, or furthest
+    beyond the last one. A volatile item is refreshed more often, up to
+    1 + boost times at volatility 1.
+
+    Args:
+        steps: (days ahead, interval in days) pairs in ascending order.
+        furthest: interval in days beyond the last step.
+        boost: how much volatility shortens the interval.
+        shortest: lower bound of every interval in days.
+        discovery: interval in days of explorer items without a month.
+        unknown: volatility assumed for items without history yet.
+        retry: interval in days after a failed refresh.
+
+    """
+    def __init__(self, steps=((14, 1), (60, 2), (180, 4), (365, 7)), furthest=14, boost=3.0, shortest=1,
+                 discovery=7, unknown=0.5, retry=1.0 / 24):
+        self.steps = steps
+        self.furthest = furthest
+        self.boost = boost
+        self.shortest = shortest
+        self.discovery = discovery
+        self.unknown = unknown
+        self.retry = timedelta(days=retry)
+
+    def interval(self, days_ahead, volatility):
+        """timedelta until the next refresh, days_ahead None for items without a month"""
+        if days_ahead is None:
+            return timedelta(days=self.discovery)
+        base = next((interval for limit, interval in self.steps if days_ahead <= limit), self.furthest)
+        if volatility is None:
+            volatility = self.unknown
+        return timedelta(days=max(self.shortest, base / (1.0 + self.boost * volatility)))
+
+
+def volatility(history):
+    """Share of consecutive observations of a key whose price changed, and the last report date.
+
+    Args:
+        history: (key, report date, price) rows ordered by key and report date,
+            as returned by the scrapers' price_history().
+
+    Returns:
+        (volatility, last report date), volatility None without two
+        observations of any key and last None without any.
+
+    """
+    changes = pairs = 0
+    last = previous_key = previous_price = None
+    for key, report_date, price in history:
+        if key == previous_key:
+            pairs += 1
+            changes += price != previous_price
+        previous_key, previous_price = key, price
+        last = max(last or report_date, report_date)
+    return (float(changes) / pairs if pairs else None), last
+
+
+class Scheduler(object):
+    """Refreshes the work items of one or more scrapers as they come due.
+
+    A scraper takes part through start_day(), work_items(), refresh() and
+    price_history(), see HRGCoastalPScraper and HurtigrutenAPI. At the start
+    of every report date its storage is reopened and items not queued yet
+    are added; items of departure months that have passed are dropped.
+
+    Args:
+        scrapers: dict of name -> scraper.
+        clock: Clock (default) or FakeClock.
+        policy: Policy of the refresh intervals.
+        months: departure months ahead to schedule.
+        lookback: days of stored history the volatility is measured over.
+        metrics: directory to write the metrics of every scraper to after each refresh.
+
+    """
+    def __init__(self, scrapers, clock=None, policy=None, months=12, lookback=28, metrics=None):
+        self.scrapers = scrapers
+        self.clock = clock or Clock()
+        self.policy = policy or Policy()
+        self.months = months
+        self.lookback = lookback
+        self.metrics = metrics
+        # (due, sequence number, item), the sequence number keeps items out of the comparison
+        self.queue = []
+        self.queued = set()
+        self.sequence = itertools.count()
+        self.day = None
+
+    def schedule(self, item, due):
+        heapq.heappush(self.queue, (due, next(self.sequence), item))
+        self.queued.add(item)
+
+    def start_day(self, now):
+        """Opens report date now for every scraper and queues its new work items"""
+        day = '{:%Y-%m-%d}'.format(now)
+        if day == self.day:
+            return
+        self.day = day
+        for name, scraper in self.scrapers.items():
+            scraper.start_day(day)
+            for target, market, month in scraper.work_items(self.months):
+                item = Item(name, target, market, month)
+                if item not in self.queued:
+                    self.schedule(item, self.due(item, now))
+
+    def due(self, item, now, refreshed=False):
+        """When item is due next, now if it has never been refreshed"""
+        since = '{:%Y-%m-%d}'.format(now - timedelta(days=self.lookback))
+        measured, last = volatility(self.scrapers[item.scraper].price_history(item.target, item.market, item.month, since))
+        if refreshed:
+            last = self.day
+        if last is None:
+            return now
+        days_ahead = None
+        if item.month is not None:
+            days_ahead = max(0, (datetime.strptime(item.month, '%Y-%m') - datetime.strptime(self.day, '%Y-%m-%d')).days)
+        return max(now, datetime.strptime(last, '%Y-%m-%d') + self.policy.interval(days_ahead, measured))
+
+    def refresh(self, item, now):
+        """Refreshes item and queues it again"""
+        scraper = self.scrapers[item.scraper]
+        if item.month is not None and item.month < self.day[:7]:
+            scraper.metrics.inc('refreshes_total', result='dropped')
+            return
+        try:
+            with scraper.metrics.time('stage_seconds', stage='refresh'):
+                listed = scraper.refresh(item.target, item.market, item.month)
+                scraper.sink.flush()
+        except Exception as error:
+            scraper.metrics.failure('refresh', error)
+            scraper.metrics.inc('refreshes_total', result='failed')
+            self.schedule(item, now + self.policy.retry)
+            return
+        if listed is False:
+            scraper.metrics.inc('refreshes_total', result='dropped')
+            return
+        scraper.metrics.inc('refreshes_total', result='done')
+        self.schedule(item, self.due(item, now, refreshed=True))
+
+    def run(self, until=None):
+        """Refreshes items as they come due, until the clock reaches until (a datetime) or forever"""
+        while True:
+            now = self.clock.now()
+            if until is not None and now >= until:
+                break
+            self.start_day(now)
+            if not self.queue:
+                break
+            due, _, item = self.queue[0]
+            if due > now:
+                # Wake up at midnight at the latest to open the next report date
+                wake = min(due, datetime(now.year, now.month, now.day) + timedelta(days=1))
+                if until is not None:
+                    wake = min(wake, until)
+                self.clock.sleep((wake - now).total_seconds())
+                continue
+            heapq.heappop(self.queue)
+            self.queued.discard(item)
+            self.refresh(item, now)
+            if self.metrics:
+                for scraper in self.scrapers.values():
+                    scraper.metrics.write(self.metrics)
+
+    def close(self):
+        for scraper in self.scrapers.values():
+            if getattr(scraper, 'connection', None) is not None:
+                scraper.sink.close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scraper', action='append', choices=['coastal', 'explorer'], help='scraper to schedule, repeatable (default: both)')
+    parser.add_argument('--months', type=int, default=12, help='departure months ahead to schedule')
+    parser.add_argument('--lookback', type=int, default=28, help='days of history the price volatility is measured over')
+    parser.add_argument('--metrics', help='directory to write <scraper>.json and <scraper>.prom to after every refresh')
+    args = parser.parse_args()
+    scrapers = {}
+    for name in args.scraper or ['coastal', 'explorer']:
+        if name == 'coastal':
+            from PricingV2 import HRGCoastalPScraper
+            scrapers[name] = HRGCoastalPScraper()
+        else:
+            from Explorer_pricescraper import HurtigrutenAPI
+            scrapers[name] = HurtigrutenAPI()
+        if args.metrics:
+            scrapers[name].metrics = Metrics(name)
+    scheduler = Scheduler(scrapers, months=args.months, lookback=args.lookback, metrics=args.metrics)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.close()
+
+
+if __name__ == '__main__':
+    main()
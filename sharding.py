@@ -0,0 +1,121 @@
+"""Multi-process scraping with a single writer process.
+
+SQLite takes one writer at a time, so the work of a run is split into
+shards that a pool of worker processes fetch and parse, while one writer
+process owns the connection and stores the parsed rows.
+
+A shard is a list of tasks (key, arg). For every task a worker calls
+scraper.run_task(arg), which hands its output to scraper.emit(unit, rows);
+in a worker emit() puts (key, unit, rows) on the queue instead of storing.
+The writer calls emit() itself for every message, in the serial order of
+the task keys, so dimension ids, fact rows and checkpoints come out the
+same as in a single-process run.
+
+Workers and the writer record into their own scraper.metrics, which are
+merged into the caller's when the run completes.
+
+"""
+
+import multiprocessing
+from collections import deque
+
+QUEUE_SIZE = 1000
+
+_scraper = None
+
+
+def _init(scraper, queue, processes):
+    """Pool initializer: every worker keeps its own copy of the scraper"""
+    global _scraper
+    _scraper = scraper
+    _scraper.queue = queue
+    # Forked workers inherit the parent's connection, closed before the run; only the writer stores
+    for name in ('checkpoints', 'tour_pages'):
+        if getattr(_scraper, name, None) is not None:
+            getattr(_scraper, name).connection = None
+    # The rate limits apply to the run, not to each process
+    client = _scraper.client
+    client.reset()
+    if client.rate:
+        client.rate = client.rate / float(processes)
+    client.rate_limits = dict((host, rate / float(processes)) for host, rate in client.rate_limits.items())
+
+
+def _work(shard):
+    """Runs the tasks of one shard in a worker, returns its failed work (retried and not) and metrics"""
+    _scraper.fails = []
+    _scraper.incomplete = []
+    _scraper.metrics = _scraper.client.metrics = _scraper.metrics.spawn()
+    for key, arg in shard:
+        _scraper.task = key
+        _scraper.run_task(arg)
+        # Marks the task complete for the writer
+        _scraper.queue.put((key, None, None))
+    return _scraper.fails, _scraper.incomplete, _scraper.metrics
+
+
+def _write(scraper, keys, queue, results):
+    """Writer process: stores the queued output of the tasks in the order of keys, sends back its metrics"""
+    scraper.queue = None
+    scraper.metrics = scraper.metrics.spawn()
+    scraper.open_storage()
+    order = iter(keys)
+    current = next(order, None)
+    pending = {}
+    while current is not None:
+        key, unit, rows = queue.get()
+        pending.setdefault(key, deque()).append((unit, rows))
+        while current is not None and pending.get(current):
+            unit, rows = pending[current].popleft()
+            if unit is None and rows is None:
+                del pending[current]
+                current = next(order, None)
+            else:
+                scraper.emit(unit, rows)
+    scraper.sink.close()
+    results.send(scraper.metrics)
+
+
+def run(scraper, shards, processes):
+    """Runs the shards on processes workers and one writer.
+
+    Returns the failed work of the workers as (fails, incomplete), the work
+    to retry and the work that failed for good (see the scrapers' fail()).
+
+    The metrics of the workers and the writer are merged into scraper.metrics.
+
+    Task keys must sort in the order the tasks would run serially. The
+    scraper's sink must be closed before calling this, the writer opens its
+    own with scraper.open_storage() and also feeds the export sinks.
+
+    """
+    queue = multiprocessing.Queue(QUEUE_SIZE)
+    keys = sorted(key for shard in shards for key, _ in shard)
+    results, sender = multiprocessing.Pipe(duplex=False)
+    writer = multiprocessing.Process(target=_write, args=(scraper, keys, queue, sender))
+    writer.start()
+    # Only the writer holds the sending end now, so recv() fails instead of blocking if it dies
+    sender.close()
+    fails, incomplete = [], []
+    pool = multiprocessing.Pool(processes, initializer=_init, initargs=(scraper, queue, processes))
+    try:
+        for shard_fails, shard_incomplete, metrics in pool.imap(_work, shards):
+            fails.extend(shard_fails)
+            incomplete.extend(shard_incomplete)
+            scraper.metrics.merge(metrics)
+        # Workers that exit normally flush what they queued, terminated ones may lose it
+        pool.close()
+        pool.join()
+    except BaseException:
+        pool.terminate()
+        # The writer would wait forever for the output of the lost tasks
+        writer.terminate()
+        raise
+    try:
+        scraper.metrics.merge(results.recv())
+    except EOFError:
+        pass
+    writer.join()
+    if writer.exitcode != 0:
+        raise RuntimeError('writer process exited with code {}'.format(writer.exitcode))
+    return fails, incomplete
@@ -0,0 +1,242 @@
+"""Sinks the scrapers write their price records to.
+
+A scraper writes every batch of parsed records (the namedtuples of
+parsing.py) through a FanOut to its storage.StarSchema, which stays on the
+scraper's thread, and to any export sinks in scraper.exports:
+
+    CsvSink(path)         appends to a CSV file with a header row
+    NdjsonSink(path)      appends one JSON object per record to a file
+    ParquetSink(directory)
+                          writes a part file per run under
+                          <directory>/ReportDate=YYYY-MM-DD/ (the layout and
+                          parquet_schema() of export.py), needs pyarrow
+
+Export sinks only queue the records in write(); each one buffers them and
+writes them in bulk on a thread of its own, so adding an export does not
+hold up the scrape loop. Records are written every batch_size records and
+at close(), which waits for the thread and raises the error it stopped on,
+if any. A closed sink starts over on the next write(), appending to its
+file (or adding a part file).
+
+The export sinks get every parsed record, including those the fact table
+ignores as a duplicate of a key already stored for the report date.
+
+Usage: python PricingV2.py --csv prices.csv --parquet parquet
+
+"""
+
+import csv
+import json
+import os
+import queue
+import threading
+import uuid
+
+# Records an export sink buffers before writing them
+BATCH_SIZE = 10000
+# Batches queued per export sink before write() blocks
+QUEUE_SIZE = 100
+# Arrow types of the numeric fields in Parquet, all other fields are strings
+PARQUET_TYPES = {'occupancy': 'int64', 'viaKKN': 'bool_', 'price': 'float64'}
+
+
+def parquet_schema(fields):
+    """pyarrow schema of the record fields, used by ParquetSink and export.py alike"""
+    import pyarrow
+    return pyarrow.schema([(field, getattr(pyarrow, PARQUET_TYPES.get(field, 'string'))()) for field in fields])
+
+
+class FanOut(object):
+    """Writes every batch of records to each of several sinks.
+
+    Sinks are written, flushed and closed in order; close() closes all of
+    them and then raises the first error.
+
+    """
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def write(self, rows):
+        if len(self.sinks) > 1:
+            rows = list(rows)
+        for sink in self.sinks:
+            sink.write(rows)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        errors = []
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as error:
+                errors.append(error)
+        if errors:
+            raise errors[0]
+
+
+class ThreadedSink(object):
+    """Base of the export sinks: buffers records and writes them in bulk on its own thread.
+
+    Subclasses implement open_file(fields), write_batch(rows) and
+    close_file(), all called on the sink's thread; open_file() gets the
+    field names of the first record, before the first batch.
+
+    Args:
+        batch_size: records written at a time.
+
+    """
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.thread = None
+        self.queue = None
+        self.error = None
+
+    def __getstate__(self):
+        # Worker processes of a sharded run get the configuration, not the thread
+        state = self.__dict__.copy()
+        state.update(thread=None, queue=None, error=None)
+        return state
+
+    def write(self, rows):
+        if self.thread is None:
+            self.queue = queue.Queue(QUEUE_SIZE)
+            self.thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+            self.thread.start()
+        self.queue.put(list(rows))
+
+    def flush(self):
+        """Nothing to do: records are written every batch_size records and at close()"""
+
+    def close(self):
+        """Writes the remaining records, waits for the thread and raises the error it stopped on"""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = self.queue = None
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def run(self):
+        buffer = []
+        opened = False
+        while True:
+            rows = self.queue.get()
+            # After an error the queue is still drained, write() must never block on it
+            if self.error is None:
+                try:
+                    if rows is not None:
+                        buffer.extend(rows)
+                    if buffer and (rows is None or len(buffer) >= self.batch_size):
+                        if not opened:
+                            self.open_file(buffer[0]._fields)
+                            opened = True
+                        self.write_batch(buffer)
+                        buffer = []
+                except Exception as error:
+                    self.error = error
+                    buffer = []
+            if rows is None:
+                break
+        if opened:
+            try:
+                self.close_file()
+            except Exception as error:
+                self.error = self.error or error
+
+    def open_file(self, fields):
+        raise NotImplementedError
+
+    def write_batch(self, rows):
+        raise NotImplementedError
+
+    def close_file(self):
+        raise NotImplementedError
+
+
+class CsvSink(ThreadedSink):
+    """Appends records to a CSV file, with a header row if the file is new"""
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        ThreadedSink.__init__(self, batch_size)
+        self.path = path
+
+    def open_file(self, fields):
+        self.file = open(self.path, 'a', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        if not self.file.tell():
+            self.writer.writerow(fields)
+
+    def write_batch(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close_file(self):
+        self.file.close()
+
+
+class NdjsonSink(ThreadedSink):
+    """Appends records to a file as one JSON object per line"""
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        ThreadedSink.__init__(self, batch_size)
+        self.path = path
+
+    def open_file(self, fields):
+        self.fields = fields
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def write_batch(self, rows):
+        self.file.write(''.join(json.dumps(dict(zip(self.fields, row))) + '\n' for row in rows))
+        self.file.flush()
+
+    def close_file(self):
+        self.file.close()
+
+
+class ParquetSink(ThreadedSink):
+    """Writes the records of a run to a new part file of a Parquet dataset, one row group per batch.
+
+    The dataset is partitioned by ReportDate like the one export.py writes;
+    a run has a single report date, the one of its first record.
+
+    """
+    def __init__(self, directory, batch_size=BATCH_SIZE):
+        ThreadedSink.__init__(self, batch_size)
+        self.directory = directory
+
+    def open_file(self, fields):
+        # The report date is the partition, as in export.py it is not repeated in the file
+        self.columns = [(i, field) for i, field in enumerate(fields) if field != 'ReportDate']
+        self.schema = parquet_schema([field for _, field in self.columns])
+        self.writer = None
+
+    def write_batch(self, rows):
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.Table.from_arrays([pyarrow.array([row[i] for row in rows], type=self.schema.field(field).type)
+                                           for i, field in self.columns], schema=self.schema)
+        if self.writer is None:
+            partition = os.path.join(self.directory, 'ReportDate={}'.format(rows[0].ReportDate))
+            os.makedirs(partition, exist_ok=True)
+            path = os.path.join(partition, 'part-{}.parquet'.format(uuid.uuid4().hex))
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.writer.write_table(table)
+
+    def close_file(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def exports(csv=None, ndjson=None, parquet=None):
+    """Export sinks for the --csv, --ndjson and --parquet options of the scrapers"""
+    sinks = []
+    if csv:
+        sinks.append(CsvSink(csv))
+    if ndjson:
+        sinks.append(NdjsonSink(ndjson))
+    if parquet:
+        sinks.append(ParquetSink(parquet))
+    return sinks
@@ -0,0 +1,527 @@
+"""Storage helpers shared by the coastal and Explorer scrapers.
+
+Both scrapers write to the same star schema in Pricing.db: a fact table
+(Data or Data_Explorer) keyed on the ids of a set of dimension tables,
+through a StarSchema sink (see sinks.py for the export sinks next to it).
+
+A database is in one of two formats, recorded in PRAGMA user_version:
+
+    0 (original)  AUTOINCREMENT ids for every dimension, REAL values,
+                  fact tables with a rowid next to their primary key index
+    2 (compact)   the ids of dimReportDate and dimDepartureDate are day
+                  numbers (days since 1970-01-01), prices are stored as
+                  integer minor units (hundredths), occupancy and viaKKN
+                  as small integers, and the fact tables are WITHOUT ROWID,
+                  clustered on report date and market (see schema())
+
+Both formats have the same tables and columns, so queries joining the
+dimension tables work on either; only the price has to be divided by 100
+in the compact format. migrate.py converts an existing database.
+
+"""
+
+import datetime
+import json
+import sqlite3
+
+from metrics import DISABLED
+
+
+# PRAGMA user_version of the compact format
+COMPACT = 2
+EPOCH = datetime.date(1970, 1, 1)
+# Dimensions whose ids are day numbers in the compact format
+DAY_DIMENSIONS = ('dimReportDate', 'dimDepartureDate')
+# day_number() in SQL, for a date (or datetime) TEXT column; julianday('1970-01-01') is 2440587.5
+DAY_SQL = 'CAST(round(julianday(substr({}, 1, 10)) - 2440587.5) AS integer)'
+
+
+def day_number(value):
+    """Days since 1970-01-01 of a 'YYYY-MM-DD...' date, the id of a date dimension in the compact format"""
+    return (datetime.date(int(value[:4]), int(value[5:7]), int(value[8:10])) - EPOCH).days
+
+
+def minor(price):
+    """Price in integer minor units as stored in the compact format, a missing price stays NULL"""
+    if price is None:
+        return None
+    return int(round(price * 100))
+
+
+def is_compact(connection, compact=False):
+    """Whether the database is in the compact format.
+
+    An existing database keeps the format it was created in; an empty one
+    is to be created compact if compact is set.
+
+    """
+    if connection.execute('SELECT 1 FROM sqlite_master LIMIT 1;').fetchone():
+        return connection.execute('PRAGMA user_version;').fetchone()[0] >= COMPACT
+    return compact
+
+
+def schema(compact, table, keys):
+    """Format dependent parts of the scrapers' CREATE statements.
+
+    Args:
+        compact: whether the database is in the compact format.
+        table: name of the fact table.
+        keys: key columns of the fact table following rDate_id.
+
+    In the compact format the fact table is clustered on report date and
+    market first, which makes the separate <table>_market index redundant;
+    on a WITHOUT ROWID table every index entry would repeat the whole key.
+
+    """
+    if compact:
+        key = ['rDate_id', 'source_id', 'cat_id'] + [c for c in keys if c not in ('source_id', 'cat_id')]
+        return {'day_id': 'integer PRIMARY KEY', 'value': 'integer', 'rowid': ' WITHOUT ROWID', 'version': COMPACT,
+                'key': ', '.join(key), 'market_index': ''}
+    return {'day_id': 'integer PRIMARY KEY AUTOINCREMENT', 'value': 'real', 'rowid': '', 'version': 0,
+            'key': ', '.join(['rDate_id'] + list(keys)),
+            'market_index': 'CREATE INDEX IF NOT EXISTS {0}_market ON {0} (source_id, rDate_id, cat_id);'.format(table)}
+
+
+class DimensionCache(object):
+    """Resolves dimension values to their ids without a round trip per row.
+
+    The existing rows of every dimension table are preloaded into dicts;
+    the database is only touched for values that have not been seen yet.
+
+    Args:
+        cursor: sqlite3 cursor on the database holding the dimension tables.
+        dimensions: dict of table name -> name of its UNIQUE value column.
+        days: tables whose ids are the day_number() of their value (compact format).
+
+    """
+    def __init__(self, cursor, dimensions, days=()):
+        self.cr = cursor
+        self.dimensions = dimensions
+        self.days = days
+        self.ids = {}
+        self.preload()
+
+    def preload(self):
+        """Loads all existing dimension rows into memory"""
+        for table, column in self.dimensions.items():
+            self.cr.execute('SELECT {}, id FROM {};'.format(column, table))
+            self.ids[table] = dict(self.cr.fetchall())
+
+    def id(self, table, value, extra=None):
+        """Returns the id of value in table, inserting it if it is new.
+
+        extra is an optional dict of additional columns written together
+        with a new value (e.g. TourImg and TourMap on dimTour).
+
+        """
+        ids = self.ids[table]
+        try:
+            return ids[value]
+        except KeyError:
+            pass
+        column = self.dimensions[table]
+        columns = [column] + list(extra or {})
+        values = [value] + list((extra or {}).values())
+        if table in self.days:
+            ids[value] = day_number(value)
+            self.cr.execute('INSERT OR IGNORE INTO {}(id, {}) VALUES (?, {});'.format(table, ', '.join(columns), ', '.join('?' * len(columns))),
+                            [ids[value]] + values)
+            return ids[value]
+        self.cr.execute('INSERT OR IGNORE INTO {}({}) VALUES ({});'.format(table, ', '.join(columns), ', '.join('?' * len(columns))), values)
+        self.cr.execute('SELECT id FROM {} WHERE {} = ?;'.format(table, column), (value, ))
+        ids[value] = self.cr.fetchone()[0]
+        return ids[value]
+
+
+def tune(connection, wal=True):
+    """Applies the PRAGMAs used for bulk loading.
+
+    WAL journaling with synchronous=NORMAL only syncs on checkpoints instead
+    of on every commit, which is safe against application crashes (only a
+    power loss can roll back the last transactions).
+
+    """
+    if wal:
+        connection.execute('PRAGMA journal_mode=WAL;')
+        connection.execute('PRAGMA synchronous=NORMAL;')
+    connection.execute('PRAGMA temp_store=MEMORY;')
+    connection.execute('PRAGMA cache_size=-65536;')
+
+
+class FactWriter(object):
+    """Buffers fact rows and writes them with executemany in one transaction.
+
+    Rows keep the INSERT OR IGNORE semantics of the per-row inserts, so a
+    row whose composite primary key already exists is still skipped.
+
+    If latest is given, the same rows are upserted into that table, which
+    has the columns of the fact table but is keyed without the report date,
+    so it holds the most recent price of every key (the first row of a key
+    within a report date wins, as in the fact table). Report dates are
+    compared through dimReportDate, not by id: a past report date loaded
+    later (a replay) gets a higher id in the original format. The table is
+    filled from the fact table the first time it is found empty.
+
+    Args:
+        connection: sqlite3 connection the rows are written to.
+        table: name of the fact table.
+        columns: column names, in the order rows are given to add().
+        batch_size: flush automatically once this many rows are buffered.
+            With None rows are only written when flush() is called.
+        latest: name of the latest-price table, or None.
+        keys: number of key columns following the report date column (with latest).
+        metrics: metrics.Metrics the rows written and ignored and the commit times are recorded in.
+
+    """
+    def __init__(self, connection, table, columns, batch_size=None, latest=None, keys=None, metrics=DISABLED):
+        self.connection = connection
+        self.table = table
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self.sql = 'INSERT OR IGNORE INTO {}({}) VALUES ({});'.format(table, ', '.join(columns), ', '.join('?' * len(columns)))
+        self.rows = []
+        self.latest_sql = None
+        if latest:
+            rdate, key_columns, value_columns = columns[0], columns[1:keys + 1], columns[keys + 1:]
+            self.latest_sql = '''INSERT INTO {0}({1}) VALUES ({2}) ON CONFLICT({3}) DO UPDATE SET {4}
+                                 WHERE (SELECT ReportDate FROM dimReportDate WHERE id = excluded.{5})
+                                     > (SELECT ReportDate FROM dimReportDate WHERE id = {0}.{5});'''.format(
+                latest, ', '.join(columns), ', '.join('?' * len(columns)), ', '.join(key_columns),
+                ', '.join('{0} = excluded.{0}'.format(c) for c in [rdate] + value_columns), rdate)
+            self.backfill(table, latest, columns, key_columns)
+
+    def backfill(self, table, latest, columns, key_columns):
+        """Fills an empty latest-price table from the rows already in the fact table"""
+        if self.connection.execute('SELECT 1 FROM {} LIMIT 1;'.format(latest)).fetchone():
+            return
+        # SQLite takes the bare columns of a max() aggregate from the row holding the maximum
+        self.connection.execute('''INSERT INTO {0}({1}) SELECT {1} FROM (
+                                   SELECT f.*, max(r.ReportDate) FROM {2} f JOIN dimReportDate r ON r.id = f.{3} GROUP BY {4});'''.format(
+            latest, ', '.join(columns), table, columns[0], ', '.join('f.' + c for c in key_columns)))
+        self.connection.commit()
+
+    def add(self, row):
+        self.rows.append(row)
+        if self.batch_size and len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered rows and commits them together with any pending dimension inserts"""
+        with self.metrics.time('stage_seconds', stage='commit'):
+            if self.rows:
+                written = self.connection.executemany(self.sql, self.rows).rowcount
+                if self.latest_sql:
+                    self.connection.executemany(self.latest_sql, self.rows)
+                self.metrics.inc('rows_total', written, table=self.table, result='written')
+                self.metrics.inc('rows_total', len(self.rows) - written, table=self.table, result='ignored')
+                self.rows = []
+            self.connection.commit()
+
+
+class DeltaWriter(object):
+    """Stores a fact row only when its values change between report dates.
+
+    Takes the same rows as FactWriter (rDate_id first, then the key columns,
+    then the value columns) but writes them to <table>_Delta, where each row
+    carries validFrom_id/validTo_id report date ids instead of a copy per run.
+    The open row (validTo_id IS NULL) of every key is kept in memory, so an
+    unchanged price only bumps lastSeen_id.
+
+    A key that is no longer returned (sold out, departed) is closed by
+    close_unseen() at the end of a complete run. The view
+    <table>_Delta_Snapshot rebuilds the original snapshot shape of <table>
+    for every report date the delta table was written for.
+
+    Args:
+        connection: sqlite3 connection the rows are written to.
+        table: name of the snapshot fact table, e.g. 'Data'.
+        columns: column names of the rows given to add(), rDate_id first.
+        keys: number of key columns following rDate_id.
+        batch_size: flush automatically once this many changes are buffered.
+        metrics: metrics.Metrics the rows written, unchanged and ignored are recorded in.
+        compact: create <table>_Delta in the compact format (integer values, WITHOUT ROWID).
+
+    """
+    def __init__(self, connection, table, columns, keys, batch_size=None, metrics=DISABLED, compact=False):
+        self.connection = connection
+        self.compact = compact
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self.duplicates = 0
+        self.table = table + '_Delta'
+        self.keys = keys
+        self.key_columns = list(columns[1:keys + 1])
+        self.value_columns = list(columns[keys + 1:])
+        self.create(columns[0])
+        where = ' AND '.join('{} = ?'.format(c) for c in self.key_columns)
+        self.close_sql = 'UPDATE {} SET validTo_id = ? WHERE {} AND validTo_id IS NULL;'.format(self.table, where)
+        self.touch_sql = 'UPDATE {} SET lastSeen_id = ? WHERE {} AND validTo_id IS NULL;'.format(self.table, where)
+        self.update_sql = 'UPDATE {} SET {}, lastSeen_id = ? WHERE {} AND validFrom_id = ?;'.format(
+            self.table, ', '.join('{} = ?'.format(c) for c in self.value_columns), where)
+        insert_columns = self.key_columns + self.value_columns + ['validFrom_id', 'lastSeen_id']
+        self.insert_sql = 'INSERT OR IGNORE INTO {}({}) VALUES ({});'.format(self.table, ', '.join(insert_columns), ', '.join('?' * len(insert_columns)))
+        self.load()
+        self.seen = set()
+        self.rDate_id = None
+        self.closes, self.inserts, self.updates, self.touches = [], [], [], []
+
+    def create(self, rdate_column):
+        keys = ', '.join(self.key_columns)
+        self.connection.executescript('''
+    CREATE TABLE IF NOT EXISTS {table} ({keydefs}, {valuedefs},
+                                    validFrom_id integer NOT NULL,
+                                    validTo_id integer,
+                                    lastSeen_id integer NOT NULL,
+                                    FOREIGN KEY (validFrom_id) references dimReportDate(id),
+                                    FOREIGN KEY (validTo_id) references dimReportDate(id),
+                                    PRIMARY KEY ({keys}, validFrom_id)){rowid};
+    CREATE TABLE IF NOT EXISTS DeltaReportDates (TableName TEXT NOT NULL, rDate_id integer NOT NULL, PRIMARY KEY (TableName, rDate_id));
+    CREATE VIEW IF NOT EXISTS {table}_Snapshot AS
+        SELECT r.id AS {rdate}, {dkeys}, {dvalues}
+        FROM DeltaReportDates runs
+        JOIN dimReportDate r ON r.id = runs.rDate_id
+        JOIN {table} d
+        JOIN dimReportDate f ON f.id = d.validFrom_id
+        LEFT JOIN dimReportDate t ON t.id = d.validTo_id
+        WHERE runs.TableName = '{table}' AND f.ReportDate <= r.ReportDate AND (t.ReportDate IS NULL OR r.ReportDate < t.ReportDate);
+    '''.format(table=self.table, keys=keys, rdate=rdate_column,
+               keydefs=', '.join('{} integer NOT NULL'.format(c) for c in self.key_columns),
+               valuedefs=', '.join('{} {}'.format(c, 'integer' if self.compact else 'real') for c in self.value_columns),
+               rowid=' WITHOUT ROWID' if self.compact else '',
+               dkeys=', '.join('d.' + c for c in self.key_columns),
+               dvalues=', '.join('d.' + c for c in self.value_columns)))
+
+    def load(self):
+        """Loads the open row of every key: key -> (validFrom_id, values)"""
+        n = len(self.key_columns)
+        cr = self.connection.execute('SELECT {}, {}, validFrom_id FROM {} WHERE validTo_id IS NULL;'.format(
+            ', '.join(self.key_columns), ', '.join(self.value_columns), self.table))
+        self.open = {row[:n]: (row[-1], row[n:-1]) for row in cr}
+
+    def add(self, row):
+        rdate, key, values = row[0], tuple(row[1:self.keys + 1]), tuple(row[self.keys + 1:])
+        # Same as INSERT OR IGNORE: the first row of a key in a run wins
+        if key in self.seen:
+            self.duplicates += 1
+            return
+        self.seen.add(key)
+        self.rDate_id = rdate
+        current = self.open.get(key)
+        if current is not None and current[1] == values:
+            self.touches.append((rdate, ) + key)
+        elif current is not None and current[0] == rdate:
+            # Changed again within the same report date (e.g. a resumed run): overwrite
+            self.updates.append(values + (rdate, ) + key + (rdate, ))
+            self.open[key] = (rdate, values)
+        else:
+            if current is not None:
+                self.closes.append((rdate, ) + key)
+            self.inserts.append(key + values + (rdate, rdate))
+            self.open[key] = (rdate, values)
+        if self.batch_size and len(self.touches) + len(self.inserts) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered changes in one transaction"""
+        with self.metrics.time('stage_seconds', stage='commit'):
+            cr = self.connection.cursor()
+            if self.rDate_id is not None:
+                cr.execute('INSERT OR IGNORE INTO DeltaReportDates(TableName, rDate_id) VALUES (?, ?);', (self.table, self.rDate_id))
+            cr.executemany(self.close_sql, self.closes)
+            cr.executemany(self.insert_sql, self.inserts)
+            cr.executemany(self.update_sql, self.updates)
+            cr.executemany(self.touch_sql, self.touches)
+            self.connection.commit()
+        self.metrics.inc('rows_total', len(self.inserts) + len(self.updates), table=self.table, result='written')
+        self.metrics.inc('rows_total', len(self.touches), table=self.table, result='unchanged')
+        self.metrics.inc('rows_total', self.duplicates, table=self.table, result='ignored')
+        self.closes, self.inserts, self.updates, self.touches = [], [], [], []
+        self.duplicates = 0
+
+    def close_unseen(self):
+        """Closes every open row not seen in this run.
+
+        Only call this after a complete run: keys of requests that failed
+        would otherwise be closed as if they had disappeared.
+
+        The run is the report date of the rows added to this writer. When
+        another writer stored them (the writer process of a sharded run),
+        set rDate_id to their report date id first.
+
+        """
+        self.flush()
+        if self.rDate_id is None:
+            return
+        self.connection.execute('UPDATE {} SET validTo_id = ? WHERE validTo_id IS NULL AND lastSeen_id <> ?;'.format(self.table),
+                                (self.rDate_id, self.rDate_id))
+        self.connection.commit()
+        self.load()
+
+
+class StarSchema(object):
+    """Sink writing price records to a scraper's star schema.
+
+    Opens the database and creates the scraper's tables, then resolves the
+    dimension values of every record written to ids (DimensionCache) and
+    hands the fact rows to a FactWriter, or a DeltaWriter in delta mode.
+    Records are the namedtuples of parsing.py: the dimension values in the
+    order of dimensions, followed by the fact values.
+
+    Runs on the caller's thread: Checkpoints and TourPages share the
+    connection and rely on flush() committing the rows of a unit of work
+    before the unit is marked.
+
+    Args:
+        path: database file.
+        ddl: CREATE statements of the scraper's tables, formatted with schema().
+        table: name of the fact table.
+        dimensions: dict of dimension table -> value column, in record order.
+        columns: fact table columns, rDate_id and the key columns followed by
+            the value columns, which are named as the record fields.
+        extras: dict of dimension table -> record fields written as additional
+            columns with a new value (see DimensionCache.id()).
+        mode: 'snapshot' or 'delta'.
+        compact: create a new database in the compact format.
+        wal: see tune().
+        batch_size, metrics: see FactWriter.
+
+    """
+    def __init__(self, path, ddl, table, dimensions, columns, extras=None, mode='snapshot', compact=False, wal=False,
+                 batch_size=None, metrics=DISABLED):
+        self.connection = sqlite3.connect(path)
+        tune(self.connection, wal)
+        self.cr = self.connection.cursor()
+        self.compact = is_compact(self.connection, compact)
+        self.cr.executescript(ddl.format(**schema(self.compact, table, columns[1:8])))
+        self.connection.commit()
+        self.dims = DimensionCache(self.cr, dimensions, DAY_DIMENSIONS if self.compact else ())
+        if mode == 'delta':
+            self.facts = DeltaWriter(self.connection, table, columns, 7, batch_size, metrics=metrics, compact=self.compact)
+        else:
+            self.facts = FactWriter(self.connection, table, columns, batch_size, latest=table + '_Latest', keys=7, metrics=metrics)
+        self.tables = list(dimensions)
+        self.values = list(columns[len(self.tables):])
+        self.extras = extras or {}
+
+    def ids(self, row):
+        ids = []
+        for table, value in zip(self.tables, row):
+            fields = self.extras.get(table)
+            ids.append(self.dims.id(table, value, fields and dict((field, getattr(row, field)) for field in fields)))
+        return tuple(ids)
+
+    def write(self, rows):
+        n, m = len(self.tables), len(self.tables) + len(self.values)
+        for row in rows:
+            ids = self.ids(row) if self.extras else tuple(map(self.dims.id, self.tables, row))
+            values = row[n:m]
+            if self.compact:
+                values = tuple(minor(v) if c == 'price' else v if v is None else int(v) for c, v in zip(self.values, values))
+            self.facts.add(ids + values)
+
+    def flush(self):
+        self.facts.flush()
+
+    def close(self):
+        self.facts.flush()
+        self.connection.close()
+
+
+class Checkpoints(object):
+    """Records completed units of work of a run in the Checkpoint table.
+
+    A unit is a tuple of values (e.g. reqDate, market, DP, AP) stored joined
+    with '|'. Marks are written on the scraper's connection without a commit,
+    so they are committed together with the fact rows of the unit by the
+    next flush of the writer; a crash never leaves a unit marked whose rows
+    were lost. Checkpoints of other report dates are dropped on start.
+
+    Args:
+        connection: sqlite3 connection of the run.
+        scraper: name the units are recorded under.
+        report_date: report date of the run, checkpoints only apply within it.
+
+    """
+    def __init__(self, connection, scraper, report_date):
+        self.connection = connection
+        self.scraper = scraper
+        self.report_date = report_date
+        self.connection.executescript('''
+    CREATE TABLE IF NOT EXISTS Checkpoint (ReportDate TEXT NOT NULL, Scraper TEXT NOT NULL, Cell TEXT NOT NULL,
+                                           PRIMARY KEY (ReportDate, Scraper, Cell)) WITHOUT ROWID;
+    ''')
+        self.connection.execute('DELETE FROM Checkpoint WHERE Scraper = ? AND ReportDate <> ?;', (scraper, report_date))
+        self.connection.commit()
+        cr = self.connection.execute('SELECT Cell FROM Checkpoint WHERE Scraper = ? AND ReportDate = ?;', (scraper, report_date))
+        self.completed = set(row[0] for row in cr)
+
+    def __getstate__(self):
+        # Worker processes only read the completed set
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def cell(self, unit):
+        return '|'.join(str(value) for value in unit)
+
+    def done(self, *unit):
+        return self.cell(unit) in self.completed
+
+    def mark(self, *unit):
+        cell = self.cell(unit)
+        self.completed.add(cell)
+        self.connection.execute('INSERT OR IGNORE INTO Checkpoint(ReportDate, Scraper, Cell) VALUES (?, ?, ?);', (self.report_date, self.scraper, cell))
+
+
+class TourPages(object):
+    """Product codes and sold-out flag of every Explorer tour page, with its HTTP validators.
+
+    Kept in the TourPage table so a page can be revalidated with a
+    conditional GET (If-None-Match / If-Modified-Since) instead of being
+    downloaded and parsed again. Like Checkpoints.mark(), put() writes
+    without a commit; the next flush of the fact writer commits it.
+
+    Urls put() or marked current during this run are kept in validated, so
+    the page is not requested again within the run (e.g. by a worker
+    process after the parent validated all pages).
+
+    Args:
+        connection: sqlite3 connection of the run.
+
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.connection.executescript('''
+    CREATE TABLE IF NOT EXISTS TourPage (Url TEXT NOT NULL PRIMARY KEY, Codes TEXT NOT NULL, SoldOut integer NOT NULL,
+                                         ETag TEXT, LastModified TEXT) WITHOUT ROWID;
+    ''')
+        cr = self.connection.execute('SELECT Url, Codes, SoldOut, ETag, LastModified FROM TourPage;')
+        self.pages = dict((url, (json.loads(codes), bool(sold_out), etag, modified)) for url, codes, sold_out, etag, modified in cr)
+        self.validated = set()
+
+    def __getstate__(self):
+        # Worker processes only read the pages
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def get(self, url):
+        """(codes, sold_out, etag, last_modified) of url, or None if it was never stored"""
+        return self.pages.get(url)
+
+    def headers(self, url):
+        """Conditional request headers for url, empty if nothing usable is stored"""
+        page = self.pages.get(url)
+        headers = {}
+        if page is not None and page[2]:
+            headers['If-None-Match'] = page[2]
+        if page is not None and page[3]:
+            headers['If-Modified-Since'] = page[3]
+        return headers
+
+    def put(self, url, codes, sold_out, etag=None, last_modified=None):
+        self.pages[url] = (list(codes), sold_out, etag, last_modified)
+        self.validated.add(url)
+        if self.connection is not None:
+            self.connection.execute('INSERT OR REPLACE INTO TourPage(Url, Codes, SoldOut, ETag, LastModified) VALUES (?, ?, ?, ?, ?);',
+                                    (url, json.dumps(list(codes)), int(sold_out), etag, last_modified))
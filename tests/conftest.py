@@ -0,0 +1,94 @@
+"""Fixtures shared by the tests: a stub API server and scrapers pointed at it.
+
+The scrapers and benchmarks/stub_api.py are top-level modules of the
+repository, so both directories are put on sys.path as the benchmarks do.
+
+"""
+
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import stub_api
+
+START = '2020-10-05'
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # The scrapers default to a Windows cache path, which would be created relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def fixtures():
+    """Small stub responses, tests change them before the server is first used"""
+    return stub_api.Fixtures(days=45, categories=3, tours=3, codes=2, dates=4, page_kb=1)
+
+
+@pytest.fixture
+def stub(fixtures):
+    server = stub_api.serve(fixtures)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def coastal(stub, tmp_path):
+    """Returns a new HRGCoastalPScraper on the stub, storing to dbname in tmp_path"""
+    from PricingV2 import HRGCoastalPScraper
+
+    def make(dbname='coastal.db', months=6, **attributes):
+        scraper = HRGCoastalPScraper()
+        stub_api.point(scraper, stub.base)
+        scraper.location, scraper.dbname = str(tmp_path) + os.sep, dbname
+        scraper.client.cache = None
+        scraper.client.rate = None
+        start = datetime.strptime(START, '%Y-%m-%d')
+        scraper.endDate = datetime(start.year + (start.month - 1 + months) // 12, (start.month - 1 + months) % 12 + 1, 1)
+        for name, value in attributes.items():
+            setattr(scraper, name, value)
+        return scraper
+    return make
+
+
+@pytest.fixture
+def explorer(stub, tmp_path):
+    """Returns a new HurtigrutenAPI on the stub, storing to dbname in tmp_path"""
+    from Explorer_pricescraper import HurtigrutenAPI
+
+    def make(dbname='explorer.db', **attributes):
+        scraper = HurtigrutenAPI()
+        stub_api.point(scraper, stub.base)
+        scraper.location, scraper.dbname = str(tmp_path) + os.sep, dbname
+        scraper.client.cache = None
+        scraper.client.rate = None
+        for name, value in attributes.items():
+            setattr(scraper, name, value)
+        return scraper
+    return make
+
+
+def quietly(function, *args, **kwargs):
+    """Calls function without the rows the Explorer scraper prints"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+def table(path, name):
+    """All rows of a table, sorted"""
+    connection = sqlite3.connect(path)
+    try:
+        return sorted(connection.execute('SELECT * FROM {};'.format(name)).fetchall(), key=repr)
+    finally:
+        connection.close()
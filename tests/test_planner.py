@@ -0,0 +1,87 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import START, table
+from planner import following
+
+
+@pytest.fixture
+def covered(fixtures, monkeypatch):
+    """Calendar dates served per (fromPort, toPort, market), and the number of Availability requests"""
+    served = {'requests': 0, 'dates': {}}
+    availability = fixtures.availability
+
+    def record(payload):
+        response = availability(payload)
+        served['requests'] += 1
+        lane = (payload['fromPort'], payload['toPort'], payload['marketCode'])
+        served['dates'].setdefault(lane, set()).update(day['date'] for day in response['calendar'] if day['voyages'])
+        return response
+    monkeypatch.setattr(fixtures, 'availability', record)
+    return served
+
+
+def test_following():
+    final = datetime(2021, 3, 1)
+    # The day after the last date covered, at least a month on
+    assert following(datetime(2020, 10, 1), '2020-11-14', final) == datetime(2020, 11, 15)
+    assert following(datetime(2020, 10, 1), '2020-10-20', final) == datetime(2020, 11, 1)
+    assert following(datetime(2020, 10, 1), None, final) == datetime(2020, 11, 1)
+    # Never past the last month start of the grid before a window started there
+    assert following(datetime(2021, 2, 1), '2021-03-17', final) == final
+    assert following(final, '2021-04-15', final) == datetime(2021, 4, 16)
+
+
+@pytest.mark.parametrize('days, requests', [(30, 120), (45, 100), (90, 60)])
+def test_planned_run_covers_the_grid(coastal, fixtures, covered, days, requests):
+    fixtures.days = days
+    coastal('grid.db').scrape(START)
+    grid = dict(covered['dates'])
+    assert covered['requests'] == 120
+    covered.update(requests=0, dates={})
+    scraper = coastal('planned.db', plan=True)
+    scraper.scrape(START)
+    assert covered['dates'] == grid
+    assert covered['requests'] == requests == scraper.planner.report['requests']
+    assert scraper.planner.report['saved_window'] == 120 - requests
+    assert scraper.fails == []
+
+
+def test_empty_routes_are_skipped_until_rechecked(coastal, fixtures, covered, tmp_path):
+    fixtures.empty = {('BGO', 'TRD')}
+    coastal(plan=True).scrape('2020-10-05')
+    assert ('BGO', 'TRD', 'NO') in covered['dates']
+    lanes = dict(((row[0], row[1], row[2]), row[5]) for row in table(str(tmp_path / 'coastal.db'), 'CoverageLanes'))
+    assert lanes[('BGO', 'TRD', 'NO')] == 0 and lanes[('BGO', 'KKN', 'NO')] > 0
+    covered.update(requests=0, dates={})
+    scraper = coastal(plan=True)
+    scraper.scrape('2020-10-06')
+    assert not any(lane[:2] == ('BGO', 'TRD') for lane in covered['dates'])
+    assert scraper.planner.report['empty_lanes'] == 5
+    # Probed again once the empty walk is a week old
+    covered.update(requests=0, dates={})
+    scraper = coastal(plan=True)
+    scraper.scrape('2020-10-13')
+    assert ('BGO', 'TRD', 'NO') in covered['dates']
+    assert scraper.planner.report['empty_lanes'] == 0
+
+
+def test_resumed_run_continues_at_the_first_missing_window(coastal, covered):
+    class Interrupted(BaseException):
+        pass
+    scraper = coastal(plan=True)
+    fetch = scraper.fetch
+
+    def interrupt(cell):
+        if covered['requests'] == 30:
+            raise Interrupted()
+        return fetch(cell)
+    scraper.fetch = interrupt
+    with pytest.raises(Interrupted):
+        scraper.scrape(START)
+    scraper.sink.close()
+    resumed = coastal(plan=True)
+    resumed.scrape(START)
+    assert covered['requests'] == 100
+    assert resumed.planner.report['requests'] == 70
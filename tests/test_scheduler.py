@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+from conftest import table
+from scheduler import FakeClock, Policy, Scheduler, volatility
+
+
+def test_volatility():
+    history = [(('a', ), '2020-10-01', 100), (('a', ), '2020-10-02', 100), (('a', ), '2020-10-03', 120),
+               (('b', ), '2020-10-02', 50), (('b', ), '2020-10-04', 50)]
+    assert volatility(history) == (1 / 3.0, '2020-10-04')
+    assert volatility([(('a', ), '2020-10-01', 100)]) == (None, '2020-10-01')
+    assert volatility([]) == (None, None)
+
+
+def test_policy():
+    policy = Policy()
+    assert policy.interval(7, 0) == timedelta(days=1)
+    assert policy.interval(200, 0) == timedelta(days=7)
+    assert policy.interval(200, 1) < policy.interval(200, 0)
+    assert policy.interval(None, 1) == timedelta(days=policy.discovery)
+
+
+def test_near_months_are_refreshed_more_often(coastal, fixtures, monkeypatch, tmp_path):
+    searched = []
+    availability = fixtures.availability
+
+    def record(payload):
+        searched.append(payload['searchFromDateTime'][:7])
+        return availability(payload)
+    monkeypatch.setattr(fixtures, 'availability', record)
+    scraper = coastal(markets=['NO', 'DE'])
+    start = datetime(2020, 10, 5)
+    clock = FakeClock(start)
+    scheduler = Scheduler({'coastal': scraper}, clock=clock, months=4)
+    try:
+        scheduler.run(until=start + timedelta(days=10))
+    finally:
+        scheduler.close()
+    # Ten days were simulated without waiting for them
+    assert clock.now() == start + timedelta(days=10)
+    report_dates = set(row[1] for row in table(str(tmp_path / 'coastal.db'), 'dimReportDate'))
+    assert len(report_dates) == 10
+    # Every item is refreshed on the first day, departures close by every day, later ones less often
+    assert searched[:32].count('2020-10') == 8
+    assert searched.count('2020-10') == 80
+    assert searched.count('2020-10') > searched.count('2020-11') >= searched.count('2020-12') > searched.count('2021-01')
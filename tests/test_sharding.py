@@ -0,0 +1,70 @@
+import os
+import sqlite3
+
+from conftest import START, quietly, table
+from metrics import Metrics
+
+
+def tables(path):
+    connection = sqlite3.connect(path)
+    try:
+        return sorted(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table';"))
+    finally:
+        connection.close()
+
+
+def assert_same_database(serial, sharded):
+    assert tables(sharded) == tables(serial)
+    for name in tables(serial):
+        assert table(sharded, name) == table(serial, name), name
+
+
+def test_sharded_coastal_run_matches_serial(coastal, tmp_path):
+    serial = coastal('serial.db')
+    serial.scrape(START)
+    sharded = coastal('sharded.db')
+    sharded.scrape(START, processes=2)
+    assert serial.fails == sharded.fails == []
+    assert_same_database(str(tmp_path / 'serial.db'), str(tmp_path / 'sharded.db'))
+
+
+def test_sharded_delta_run_closes_vanished_prices(coastal, fixtures, tmp_path):
+    for report_date in ('2020-10-05', '2020-10-06'):
+        # The route is gone on the second report date, its open rows must be closed
+        fixtures.empty = {('BGO', 'TRD')} if report_date == '2020-10-06' else set()
+        coastal('serial.db', storage_mode='delta').scrape(report_date)
+        sharded = coastal('sharded.db', storage_mode='delta')
+        sharded.scrape(report_date, processes=2)
+        assert sharded.fails == sharded.incomplete == []
+    assert_same_database(str(tmp_path / 'serial.db'), str(tmp_path / 'sharded.db'))
+    connection = sqlite3.connect(str(tmp_path / 'sharded.db'))
+    assert connection.execute('SELECT count(*) FROM Data_Delta WHERE validTo_id IS NOT NULL;').fetchone()[0] > 0
+    connection.close()
+
+
+def test_sharded_explorer_run_matches_serial(explorer, tmp_path):
+    serial = explorer('serial.db')
+    quietly(serial.scraper, START)
+    sharded = explorer('sharded.db')
+    quietly(sharded.scraper, START, processes=2)
+    assert serial.fails == sharded.fails == []
+    assert_same_database(str(tmp_path / 'serial.db'), str(tmp_path / 'sharded.db'))
+
+
+def test_worker_stores_the_tour_pages_it_fetches(explorer, tmp_path):
+    parent = os.getpid()
+    scraper = explorer(metrics=Metrics('explorer'))
+    tour_page = scraper.tour_page
+
+    def fails_in_parent(i):
+        # The page is left to the worker, which inherits the parent's closed connection under fork
+        if i == 1 and os.getpid() == parent:
+            raise ValueError('tour page')
+        return tour_page(i)
+    scraper.tour_page = fails_in_parent
+    quietly(scraper.scraper, START, processes=2)
+    assert scraper.fails == []
+    assert not any(name == 'failures_total' and ('stage', 'tour_page') in labels and ('reason', 'ProgrammingError') in labels
+                   for name, labels in scraper.metrics.counters)
+    pages = [row[0] for row in table(str(tmp_path / 'explorer.db'), 'TourPage')]
+    assert len(pages) == 3 and pages[1].endswith('/tour/1')
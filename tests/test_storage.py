@@ -0,0 +1,93 @@
+import sqlite3
+
+import pytest
+
+# Coastal prices with their dimension values, comparable between databases
+PRICES = '''
+    SELECT r.ReportDate, s.ShipCode, c.Category, v.VoyageType, d.DepartureDate, dp.PortName, ap.PortName, m.SourceMarket,
+           f.occupancy, f.viaKKN, f.price
+    FROM {} f
+    JOIN dimReportDate r ON r.id = f.rDate_id
+    JOIN dimShips s ON s.id = f.ship_id
+    JOIN dimCabinCategory c ON c.id = f.cat_id
+    JOIN dimVoyage v ON v.id = f.type_id
+    JOIN dimDepartureDate d ON d.id = f.dep_id
+    JOIN dimDeparturePorts dp ON dp.id = f.dport_id
+    JOIN dimArrivalPorts ap ON ap.id = f.aport_id
+    JOIN dimSourceMarket m ON m.id = f.source_id;'''
+
+
+def prices(path, table):
+    connection = sqlite3.connect(path)
+    try:
+        return sorted(connection.execute(PRICES.format(table)).fetchall())
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('run_kind', ['serial', 'sharded', 'failed', 'failed sharded'])
+@pytest.mark.parametrize('compact', [False, True])
+def test_delta_snapshot_view_matches_snapshot_mode(coastal, fixtures, monkeypatch, tmp_path, compact, run_kind):
+    run = {'day': 0}
+    availability = fixtures.availability
+
+    def moving(payload):
+        response = availability(payload)
+        day = run['day']
+        route = (payload['fromPort'], payload['toPort'])
+        # In failed runs the route's responses can't be parsed on the second report date
+        if 'failed' in run_kind and day == 1 and route == ('BGO', 'TRD'):
+            del response['calendar'][0]['voyages']
+            return response
+        for date in response['calendar']:
+            # The route disappears on the third report date and is back on the fourth
+            if day == 2 and route == ('BGO', 'KKN'):
+                date['voyages'] = None
+                continue
+            for voyage in date['voyages']:
+                for n, category in enumerate(voyage['categoryPrices']):
+                    if (n + day) % 3 == 0:
+                        category['price']['amount'] += 10 * day
+        return response
+    monkeypatch.setattr(fixtures, 'availability', moving)
+    processes = 2 if 'sharded' in run_kind else None
+    for day, report_date in enumerate(['2020-10-05', '2020-10-06', '2020-10-07', '2020-10-08']):
+        run['day'] = day
+        coastal('snapshot.db', months=3, compact=compact).scrape(report_date)
+        coastal('delta.db', months=3, compact=compact, storage_mode='delta').scrape(report_date, processes=processes)
+    snapshot = prices(str(tmp_path / 'snapshot.db'), 'Data')
+    assert len(set(row[0] for row in snapshot)) == 4
+    expected = snapshot
+    if 'failed' in run_kind:
+        # The rows of the failed route stay open, so the view repeats its previous prices
+        expected = sorted(snapshot + [('2020-10-06', ) + row[1:] for row in snapshot if row[0] == '2020-10-05' and row[5:7] == ('BGO', 'TRD')])
+        assert len(expected) > len(snapshot)
+    assert prices(str(tmp_path / 'delta.db'), 'Data_Delta_Snapshot') == expected
+    # Unchanged prices were not stored again
+    connection = sqlite3.connect(str(tmp_path / 'delta.db'))
+    assert connection.execute('SELECT count(*) FROM Data_Delta;').fetchone()[0] < len(snapshot)
+    connection.close()
+
+
+def test_delta_mode_keeps_the_rows_of_failed_cells_open(coastal, fixtures, monkeypatch, tmp_path):
+    run = {'day': 0}
+    availability = fixtures.availability
+
+    def unparsable(payload):
+        response = availability(payload)
+        # A response without voyages on the second report date raises KeyError, which is not retried
+        if run['day'] == 1 and (payload['fromPort'], payload['toPort']) == ('BGO', 'TRD'):
+            del response['calendar'][0]['voyages']
+        return response
+    monkeypatch.setattr(fixtures, 'availability', unparsable)
+    coastal(months=3, storage_mode='delta').scrape('2020-10-05')
+    run['day'] = 1
+    scraper = coastal(months=3, storage_mode='delta')
+    scraper.scrape('2020-10-06')
+    assert scraper.fails == [] and len(scraper.incomplete) == 15
+    view = prices(str(tmp_path / 'coastal.db'), 'Data_Delta_Snapshot')
+    first = [row[1:] for row in view if row[0] == '2020-10-05']
+    assert [row[1:] for row in view if row[0] == '2020-10-06'] == first
+    connection = sqlite3.connect(str(tmp_path / 'coastal.db'))
+    assert connection.execute('SELECT count(*) FROM Data_Delta WHERE validTo_id IS NOT NULL;').fetchone()[0] == 0
+    connection.close()